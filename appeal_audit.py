@@ -0,0 +1,209 @@
+"""Offline audit of exported appeal channel history against a format config.
+
+Streams one or more JSONL dumps (one Discord message object per line, as
+the API returns them: `id`, `content`, `author`, and `member.roles` for the
+whitelist check) through the same whitelist, format and Steam ID checks the
+bot runs, spread over a process pool. Prints how many appeals each rule
+would reject with a few sample offenders, without a network or token:
+
+    python appeal_audit.py history.jsonl --guild 1234
+    python appeal_audit.py history.jsonl.gz --guild 1234 --format-file new_format.txt
+    python appeal_audit.py *.jsonl --ignore-case --tolerant-whitespace --output audit.json
+
+Lines are read in chunks and only a bounded number of chunks are in flight
+at once, so memory stays flat however large the dump is.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import collections
+import concurrent.futures
+from validation import DEFAULT_MESSAGE_FORMAT, check_appeal
+
+CHUNK_LINES = 2000
+SAMPLE_CHARS = 200
+
+# Set in each worker process by _init_worker
+_format_config = None
+
+
+def _init_worker(format_config):
+    global _format_config
+    _format_config = format_config
+
+
+def message_role_ids(message):
+    member = message.get('member') or {}
+    return [int(role_id) for role_id in member.get('roles') or message.get('role_ids') or ()]
+
+
+def audit_chunk(lines, samples):
+    """Check one chunk of JSONL lines, returning counts and up to `samples` offenders per rule."""
+    counts = collections.Counter()
+    fields = collections.Counter()
+    offenders = collections.defaultdict(list)
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            message = json.loads(line)
+            content = message.get('content') or ''
+            author = message.get('author') or {}
+            role_ids = message_role_ids(message)
+        except (ValueError, TypeError, AttributeError):
+            counts['unreadable'] += 1
+            continue
+        if author.get('bot'):
+            counts['bot'] += 1
+            continue
+        result = check_appeal(0, _format_config, content, role_ids)
+        if result is None:
+            counts['whitelisted'] += 1
+            continue
+        rule = result.reason or 'valid'
+        counts[rule] += 1
+        if result.valid:
+            continue
+        fields[(rule, result.field)] += 1
+        if len(offenders[rule]) < samples:
+            offenders[rule].append({
+                "message_id": message.get('id'),
+                "author_id": author.get('id'),
+                "field": result.field,
+                "content": content[:SAMPLE_CHARS],
+            })
+    return counts, fields, dict(offenders)
+
+
+def read_chunks(paths, size=CHUNK_LINES):
+    for path in paths:
+        if path == '-':
+            file = sys.stdin
+        else:
+            opener = gzip.open if path.endswith('.gz') else open
+            file = opener(path, 'rt', encoding='utf-8')
+        try:
+            chunk = []
+            for line in file:
+                chunk.append(line)
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+
+def run_audit(paths, format_config, workers, samples, chunk_lines=CHUNK_LINES):
+    counts = collections.Counter()
+    fields = collections.Counter()
+    offenders = collections.defaultdict(list)
+
+    def merge(result):
+        chunk_counts, chunk_fields, chunk_offenders = result
+        counts.update(chunk_counts)
+        fields.update(chunk_fields)
+        for rule, entries in chunk_offenders.items():
+            offenders[rule].extend(entries[:samples - len(offenders[rule])])
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(format_config,)) as pool:
+        # Chunks are merged in file order, so the samples are the earliest offenders
+        in_flight = collections.deque()
+        for chunk in read_chunks(paths, chunk_lines):
+            in_flight.append(pool.submit(audit_chunk, chunk, samples))
+            if len(in_flight) >= workers * 2:
+                merge(in_flight.popleft().result())
+        while in_flight:
+            merge(in_flight.popleft().result())
+    return counts, fields, dict(offenders)
+
+
+def load_format_config(args):
+    format_config = {}
+    if args.guild is not None:
+        from config_store import config_backend, channel_settings
+        _, format_config = config_backend.read(args.guild, 'format')
+        if not format_config:
+            raise SystemExit(f"No format config found for guild {args.guild}")
+        if args.channel is not None:
+            format_config = channel_settings.get(args.channel, format_config)
+        format_config = dict(format_config)
+    if args.format_file:
+        with open(args.format_file, 'r', encoding='utf-8') as file:
+            format_config['message_format'] = file.read().strip()
+    if args.ignore_case:
+        format_config['format_ignore_case'] = True
+    if args.tolerant_whitespace:
+        format_config['format_tolerant_whitespace'] = True
+    if args.whitelist is not None:
+        format_config['whitelisted_roles'] = args.whitelist
+    format_config.setdefault('message_format', DEFAULT_MESSAGE_FORMAT)
+    return format_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audit exported appeal history against a format config offline")
+    parser.add_argument('paths', nargs='+', metavar='DUMP', help="JSONL message dumps (.gz allowed, - for stdin)")
+    parser.add_argument('--guild', type=int, help="Use this guild's stored format config (honours CONFIG_BACKEND)")
+    parser.add_argument('--channel', type=int, help="Apply this appeal channel's overrides, requires --guild")
+    parser.add_argument('--format-file', help="Check against the message format in this file instead")
+    parser.add_argument('--ignore-case', action='store_true', help="Check with format_ignore_case on")
+    parser.add_argument('--tolerant-whitespace', action='store_true', help="Check with format_tolerant_whitespace on")
+    parser.add_argument('--whitelist', type=int, action='append', metavar='ROLE_ID',
+                        help="Whitelisted role ID, replacing the config's whitelist (repeatable)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (default: one per CPU, %(default)s)")
+    parser.add_argument('--samples', type=int, default=5, help="Sample offenders kept per rule (default: %(default)s)")
+    parser.add_argument('--chunk-lines', type=int, default=CHUNK_LINES,
+                        help="Lines handed to a worker at a time (default: %(default)s)")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.channel is not None and args.guild is None:
+        parser.error("--channel requires --guild")
+
+    format_config = load_format_config(args)
+    start = time.perf_counter()
+    counts, fields, offenders = run_audit(args.paths, format_config, max(1, args.workers), args.samples,
+                                          args.chunk_lines)
+    elapsed = time.perf_counter() - start
+
+    checked = sum(counts[outcome] for outcome in ('valid', 'format', 'steam_id'))
+    rejected = counts['format'] + counts['steam_id']
+    print(f"{sum(counts.values())} messages in {elapsed:.1f}s: {checked} checked, {rejected} would be rejected "
+          f"({rejected / checked if checked else 0:.1%}), {counts['whitelisted']} whitelisted, "
+          f"{counts['bot']} from bots, {counts['unreadable']} unreadable", file=sys.stderr)
+    for (rule, field), count in fields.most_common():
+        print(f"{count:>10}  {rule:<10}{field}", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "dumps": args.paths,
+            "seconds": round(elapsed, 3),
+            "workers": args.workers,
+            "message_format": format_config['message_format'],
+            "format_ignore_case": bool(format_config.get('format_ignore_case', False)),
+            "format_tolerant_whitespace": bool(format_config.get('format_tolerant_whitespace', False)),
+            "whitelisted_roles": len(format_config.get('whitelisted_roles') or ()),
+        },
+        "outcomes": dict(counts),
+        "rejections": [
+            {"rule": rule, "field": field, "count": count} for (rule, field), count in fields.most_common()
+        ],
+        "samples": offenders,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import os
+import sqlite3
+import asyncio
+import logging
+import threading
+from config_store import CONFIG_DIR, CONFIG_WRITE_RETRY_MAX, DEFAULT_DUPLICATE_WINDOW_DAYS, duplicate_window_days
+
+logger = logging.getLogger('discord')
+
+APPEAL_INDEX_PATH = os.getenv('APPEAL_INDEX_PATH', os.path.join(CONFIG_DIR, 'appeals.db'))
+# Seconds new appeal records are collected before they're written in one transaction
+APPEAL_INDEX_FLUSH_INTERVAL = float(os.getenv('APPEAL_INDEX_FLUSH_INTERVAL', '2'))
+
+LOOKUP_LIMIT = 10
+
+DISCORD_EPOCH_MS = 1420070400000
+
+
+class AppealRecord:
+    """One appeal that passed validation, as stored in the index."""
+
+    __slots__ = ('message_id', 'author_id', 'channel_id', 'outcome')
+
+    def __init__(self, message_id, author_id, channel_id, outcome):
+        self.message_id = message_id
+        self.author_id = author_id
+        self.channel_id = channel_id
+        self.outcome = outcome
+
+    @property
+    def timestamp(self):
+        # Snowflakes carry their creation time, so it isn't stored separately
+        return ((self.message_id >> 22) + DISCORD_EPOCH_MS) / 1000
+
+    def __repr__(self):
+        return (f"AppealRecord(message_id={self.message_id!r}, author_id={self.author_id!r}, "
+                f"channel_id={self.channel_id!r}, outcome={self.outcome!r})")
+
+
+class SteamIdIndex:
+    """Every validated appeal per guild and SteamID64, kept in SQLite.
+
+    Rows are keyed by (guild, Steam ID, message) in a WITHOUT ROWID table of
+    plain integers, so a lookup is one primary-key range scan however many
+    appeals are stored. New records are queued in memory and written in
+    batches from a worker thread; lookups see queued records too. A batch
+    that fails to write goes back on the queue and is retried, backing off
+    up to CONFIG_WRITE_RETRY_MAX seconds.
+    """
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS appeals ("
+        " guild_id INTEGER NOT NULL,"
+        " steam_id INTEGER NOT NULL,"
+        " message_id INTEGER NOT NULL,"
+        " author_id INTEGER NOT NULL,"
+        " channel_id INTEGER NOT NULL,"
+        " outcome TEXT NOT NULL,"
+        " PRIMARY KEY (guild_id, steam_id, message_id)"
+        ") WITHOUT ROWID"
+    )
+    # Edits look up and replace the record of a single message
+    _SCHEMA_BY_MESSAGE = "CREATE INDEX IF NOT EXISTS appeals_by_message ON appeals (guild_id, message_id)"
+    _INSERT = "INSERT OR REPLACE INTO appeals VALUES (?, ?, ?, ?, ?, ?)"
+    _SELECT_BY_MESSAGE = "SELECT steam_id FROM appeals WHERE guild_id = ? AND message_id = ? LIMIT 1"
+    _DELETE_BY_MESSAGE = "DELETE FROM appeals WHERE guild_id = ? AND message_id = ?"
+    _SELECT = (
+        "SELECT message_id, author_id, channel_id, outcome FROM appeals "
+        "WHERE guild_id = ? AND steam_id = ? ORDER BY message_id DESC LIMIT ?"
+    )
+    _SELECT_PREVIOUS = (
+        "SELECT message_id, author_id, channel_id, outcome FROM appeals "
+        "WHERE guild_id = ? AND steam_id = ? AND message_id < ? AND message_id >= ? AND outcome != 'rejected' "
+        "ORDER BY message_id DESC LIMIT 1"
+    )
+
+    def __init__(self, path=APPEAL_INDEX_PATH, interval=APPEAL_INDEX_FLUSH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._conn = None
+        self._lock = threading.Lock()
+        # Rows not yet on disk, and the same rows by (guild_id, steam_id)
+        self._queue = []
+        self._unwritten = {}
+        self._task = None
+        # Held while rows go to disk, so a forget() can't run between a
+        # batch being taken off the queue and its INSERT landing
+        self._writing = asyncio.Lock()
+        self._flushing = False
+        # Set by flush() to cut short the wait before the next batch
+        self._wake = asyncio.Event()
+        self.recorded = 0
+        self.duplicates = 0
+        self.write_failed = 0
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(self._SCHEMA)
+            conn.execute(self._SCHEMA_BY_MESSAGE)
+            self._conn = conn
+        return self._conn
+
+    def record(self, guild_id, steam_id, message, outcome):
+        row = (int(guild_id), int(steam_id), message.id, message.author.id, message.channel.id, outcome)
+        self._queue.append(row)
+        self._unwritten.setdefault(row[:2], []).append(row)
+        self.recorded += 1
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        delay = self.interval
+        try:
+            while self._queue:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self._flushing:
+                    # Shutting down: flush() writes what's left
+                    break
+                if await self._write_queued():
+                    delay = self.interval
+                else:
+                    delay = min(delay * 2, CONFIG_WRITE_RETRY_MAX)
+        finally:
+            self._task = None
+
+    async def _write_queued(self):
+        async with self._writing:
+            rows, self._queue = self._queue, []
+            if not rows:
+                return True
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                self.write_failed += len(rows)
+                logger.error(f"Error writing {len(rows)} records to the Steam ID index: {e}")
+                # Retry them ahead of newer records
+                self._queue[:0] = rows
+                return False
+            # Once written, lookups read them from the database
+            for row in rows:
+                pending = self._unwritten[row[:2]]
+                pending.remove(row)
+                if not pending:
+                    del self._unwritten[row[:2]]
+            return True
+
+    def _write(self, rows):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(self._INSERT, rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _select(self, guild_id, steam_id, limit):
+        with self._lock:
+            return self._connect().execute(self._SELECT, (guild_id, steam_id, limit)).fetchall()
+
+    def _select_previous(self, guild_id, steam_id, before, since):
+        with self._lock:
+            return self._connect().execute(self._SELECT_PREVIOUS, (guild_id, steam_id, before, since)).fetchone()
+
+    def _execute(self, statement, parameters):
+        with self._lock:
+            return self._connect().execute(statement, parameters).fetchone()
+
+    async def steam_id_for(self, guild_id, message_id):
+        """Return the Steam ID a message was indexed under, or None."""
+        guild_id = int(guild_id)
+        for rows in self._unwritten.values():
+            for row in rows:
+                if row[0] == guild_id and row[2] == message_id:
+                    return row[1]
+        row = await asyncio.to_thread(self._execute, self._SELECT_BY_MESSAGE, (guild_id, message_id))
+        return row[0] if row else None
+
+    async def forget(self, guild_id, message_id):
+        """Remove a message's record, so an edited appeal can be indexed again."""
+        guild_id = int(guild_id)
+        # After any batch already on its way to disk, so its INSERT can't
+        # bring the record back once it's deleted
+        async with self._writing:
+            self._queue = [row for row in self._queue if row[0] != guild_id or row[2] != message_id]
+            for key in [key for key in self._unwritten if key[0] == guild_id]:
+                rows = [row for row in self._unwritten[key] if row[2] != message_id]
+                if rows:
+                    self._unwritten[key] = rows
+                else:
+                    del self._unwritten[key]
+            await asyncio.to_thread(self._execute, self._DELETE_BY_MESSAGE, (guild_id, message_id))
+
+    async def lookup(self, guild_id, steam_id, limit=LOOKUP_LIMIT):
+        """Return the newest appeal records for a Steam ID, newest first."""
+        key = (int(guild_id), int(steam_id))
+        rows = await asyncio.to_thread(self._select, key[0], key[1], limit)
+        records = {row[0]: AppealRecord(*row) for row in rows}
+        for row in self._unwritten.get(key, ()):
+            records[row[2]] = AppealRecord(*row[2:])
+        return sorted(records.values(), key=lambda record: record.message_id, reverse=True)[:limit]
+
+    async def find_duplicate(self, guild_id, steam_id, message_id, window_days):
+        """Return an older appeal for the same Steam ID within the window, if any.
+
+        Appeals that were themselves rejected as duplicates don't count, so a
+        repeat appellant is compared against the appeal that got through.
+        """
+        key = (int(guild_id), int(steam_id))
+        window_days = duplicate_window_days(window_days) or DEFAULT_DUPLICATE_WINDOW_DAYS
+        # Lowest snowflake that can have been created within the window
+        since = max((message_id >> 22) - int(window_days * 86400 * 1000), 0) << 22
+        row = await asyncio.to_thread(self._select_previous, key[0], key[1], message_id, since)
+        candidates = [row] if row is not None else []
+        candidates.extend(
+            pending[2:] for pending in self._unwritten.get(key, ())
+            if since <= pending[2] < message_id and pending[5] != 'rejected'
+        )
+        if not candidates:
+            return None
+        self.duplicates += 1
+        return AppealRecord(*max(candidates, key=lambda candidate: candidate[0]))
+
+    async def flush(self):
+        self._flushing = True
+        # Don't wait out the batch interval or a retry backoff, but let a
+        # batch that's already being written finish
+        self._wake.set()
+        try:
+            if self._task is not None:
+                await asyncio.gather(self._task, return_exceptions=True)
+            # One last try; records that still fail are only counted in write_failed
+            if self._queue:
+                await self._write_queued()
+        finally:
+            self._flushing = False
+            self._wake.clear()
+
+    def stats(self):
+        return {
+            "recorded": self.recorded,
+            "pending": len(self._queue),
+            "duplicates": self.duplicates,
+            "write_failed": self.write_failed,
+        }
+
+
+steam_id_index = SteamIdIndex()
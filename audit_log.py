@@ -0,0 +1,285 @@
+"""Structured, append-only audit log of enforcement decisions.
+
+Each decision is one JSON line. Lines are handed to a writer thread through
+a queue, so the event loop never waits on disk. Segments are rotated by size
+and age and compressed with gzip once closed. The same module doubles as an
+offline query tool that streams segments instead of loading them:
+
+    python audit_log.py query --guild 1234 --rule steam_id
+    python audit_log.py query --since 2024-06-01 --count-by guild_id --count-by rule
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import queue
+import shutil
+import logging
+import argparse
+import datetime
+import threading
+import collections
+from config_store import CONFIG_DIR
+
+logger = logging.getLogger('discord')
+
+# Directory for audit log segments; empty turns the audit log off
+AUDIT_LOG_DIR = os.getenv('AUDIT_LOG_DIR', os.path.join(CONFIG_DIR, 'audit'))
+# A segment is closed and compressed once it reaches this size or age
+AUDIT_LOG_MAX_BYTES = int(os.getenv('AUDIT_LOG_MAX_BYTES', str(16 * 1024 * 1024)))
+AUDIT_LOG_MAX_AGE = float(os.getenv('AUDIT_LOG_MAX_AGE', '86400'))
+# Records waiting for the writer thread before new ones are dropped
+AUDIT_QUEUE_LIMIT = int(os.getenv('AUDIT_QUEUE_LIMIT', '10000'))
+
+# Cluster workers share the directory, so each writes segments tagged with its ID
+AUDIT_WRITER_ID = int(os.getenv('CLUSTER_ID', '0'))
+
+# audit-<start time>-w<writer>[-<n>].jsonl[.gz]
+SEGMENT_PATTERN = re.compile(r'^audit-(\d{8}T\d{6}Z)-w(\d+)(?:-(\d+))?\.jsonl(\.gz)?$')
+SEGMENT_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+
+_STOP = object()
+
+
+def parse_segment_name(name):
+    """Return (start timestamp, writer ID, sequence) for a segment file name, or None."""
+    match = SEGMENT_PATTERN.match(name)
+    if match is None:
+        return None
+    started = datetime.datetime.strptime(match.group(1), SEGMENT_TIME_FORMAT)
+    return started.replace(tzinfo=datetime.timezone.utc).timestamp(), int(match.group(2)), int(match.group(3) or 0)
+
+
+def compress_segment(path):
+    with open(path, 'rb') as source, gzip.open(f'{path}.gz.tmp', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.replace(f'{path}.gz.tmp', f'{path}.gz')
+    os.remove(path)
+
+
+class AuditLog:
+    """Queue-fed writer thread appending JSON lines to rotating segments."""
+
+    def __init__(self, directory=AUDIT_LOG_DIR, max_bytes=AUDIT_LOG_MAX_BYTES, max_age=AUDIT_LOG_MAX_AGE,
+                 queue_limit=AUDIT_QUEUE_LIMIT, writer_id=AUDIT_WRITER_ID):
+        self.directory = directory
+        self.writer_id = writer_id
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._queue = queue.Queue(queue_limit)
+        self._thread = None
+        self._file = None
+        self._opened_at = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.segments = 0
+        self.write_failed = 0
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self):
+        if not self.directory or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"Writing the audit log to {self.directory}/")
+
+    def stop(self):
+        """Write out what's queued and close the segment. Blocks; run it in a thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def record(self, action, message, **fields):
+        if self._thread is None:
+            return
+        entry = {
+            "time": round(time.time(), 3),
+            "action": action,
+            "guild_id": message.guild.id if message.guild else None,
+            "channel_id": message.channel.id,
+            "message_id": message.id,
+            "author_id": message.author.id,
+        }
+        entry.update(fields)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Our segments left open by a crash never got compressed
+        for entry in os.scandir(self.directory):
+            parsed = parse_segment_name(entry.name)
+            if entry.name.endswith('.jsonl') and parsed is not None and parsed[1] == self.writer_id:
+                self._compress(entry.path)
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                break
+            try:
+                self._write(entry)
+                # Batch the flush for whatever arrived in the meantime
+                if self._queue.empty():
+                    self._file.flush()
+            except (OSError, ValueError) as e:
+                self.write_failed += 1
+                logger.error(f"Error writing to the audit log: {e}")
+        self._close_segment()
+
+    def _write(self, entry):
+        if self._file is None:
+            self._open_segment()
+        elif self._file.tell() >= self.max_bytes or time.time() - self._opened_at >= self.max_age:
+            self._close_segment()
+            self._open_segment()
+        self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.written += 1
+
+    def _open_segment(self):
+        self._opened_at = time.time()
+        stamp = time.strftime(SEGMENT_TIME_FORMAT, time.gmtime(self._opened_at))
+        prefix = f'audit-{stamp}-w{self.writer_id}'
+        path = os.path.join(self.directory, f'{prefix}.jsonl')
+        suffix = 1
+        while os.path.exists(path) or os.path.exists(f'{path}.gz'):
+            path = os.path.join(self.directory, f'{prefix}-{suffix}.jsonl')
+            suffix += 1
+        self._file = open(path, 'a', encoding='utf-8')
+        self.segments += 1
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        path = self._file.name
+        self._file.close()
+        self._file = None
+        self._compress(path)
+
+    def _compress(self, path):
+        try:
+            compress_segment(path)
+        except OSError as e:
+            logger.error(f"Error compressing audit log segment {path}: {e}")
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "segments": self.segments,
+            "write_failed": self.write_failed,
+        }
+
+
+audit_log = AuditLog()
+
+
+def iter_segments(directory, since=None, until=None):
+    """Yield segment paths in time order, skipping ones outside [since, until)."""
+    by_writer = collections.defaultdict(list)
+    for entry in os.scandir(directory):
+        parsed = parse_segment_name(entry.name)
+        if parsed is not None:
+            by_writer[parsed[1]].append((parsed[0], parsed[2], entry.path))
+    selected = []
+    for segments in by_writer.values():
+        segments.sort()
+        for index, (start, sequence, path) in enumerate(segments):
+            # A segment ends where the same writer's next one starts
+            end = segments[index + 1][0] if index + 1 < len(segments) else None
+            if until is not None and start >= until:
+                break
+            if since is not None and end is not None and end <= since:
+                continue
+            selected.append((start, sequence, path))
+    for _, _, path in sorted(selected):
+        yield path
+
+
+def iter_records(directory, since=None, until=None, prefilters=()):
+    """Stream records from every segment, one line at a time.
+
+    `prefilters` are substrings a line must contain before it is parsed, so
+    filtered queries skip decoding most of the log.
+    """
+    for path in iter_segments(directory, since, until):
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    if prefilters and not all(text in line for text in prefilters):
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a segment being written may be partial
+                        continue
+                    if since is not None and entry["time"] < since:
+                        continue
+                    if until is not None and entry["time"] >= until:
+                        continue
+                    yield entry
+        except (OSError, EOFError) as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+
+
+def parse_time(value):
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the ban appeal audit log")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    query = subparsers.add_parser('query', help="Print or count matching records")
+    query.add_argument('--dir', default=AUDIT_LOG_DIR or os.path.join(CONFIG_DIR, 'audit'),
+                       help="Audit log directory (default: %(default)s)")
+    query.add_argument('--guild', type=int, help="Only this guild ID")
+    query.add_argument('--channel', type=int, help="Only this channel ID")
+    query.add_argument('--author', type=int, help="Only this author ID")
+    query.add_argument('--action', help="Only this action (delete, flag)")
+    query.add_argument('--rule', help="Only this rule (format, steam_id, duplicate)")
+    query.add_argument('--since', type=parse_time, help="ISO date or time, UTC unless given")
+    query.add_argument('--until', type=parse_time, help="ISO date or time, UTC unless given")
+    query.add_argument('--count-by', action='append', metavar='FIELD',
+                       help="Count records per value of FIELD instead of printing them (repeatable)")
+    query.add_argument('--limit', type=int, help="Stop after printing this many records")
+    args = parser.parse_args()
+
+    filters = {
+        key: value for key, value in (
+            ('guild_id', args.guild), ('channel_id', args.channel), ('author_id', args.author),
+            ('action', args.action), ('rule', args.rule),
+        ) if value is not None
+    }
+    # Records are written with compact separators, so each filter is also a
+    # substring every matching line contains
+    prefilters = [json.dumps({key: value}, separators=(',', ':'))[1:-1] for key, value in filters.items()]
+    records = (
+        entry for entry in iter_records(args.dir, args.since, args.until, prefilters)
+        if all(entry.get(key) == value for key, value in filters.items())
+    )
+
+    if args.count_by:
+        counts = collections.Counter(tuple(entry.get(field) for field in args.count_by) for entry in records)
+        for key, count in counts.most_common():
+            print(f"{count:>10}  " + '  '.join(f"{field}={value}" for field, value in zip(args.count_by, key)))
+        return
+    for printed, entry in enumerate(records):
+        if args.limit is not None and printed >= args.limit:
+            break
+        sys.stdout.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+import os
+import asyncio
+import logging
+import discord
+from config_store import load_config, save_config, peek_config, appeal_channels, channel_settings
+from validation import role_whitelists, validate_appeal
+from enforcement import enforcement, member_role_ids
+
+logger = logging.getLogger('discord')
+
+# Appeal channels scanned at the same time after a restart or reconnect
+BACKLOG_SCAN_WORKERS = int(os.getenv('BACKLOG_SCAN_WORKERS', '4'))
+# Messages read from one channel per history request while catching up
+BACKLOG_SCAN_LIMIT = int(os.getenv('BACKLOG_SCAN_LIMIT', '1000'))
+# Tries at scanning a channel that keeps failing before its backlog is given up
+BACKLOG_SCAN_ATTEMPTS = int(os.getenv('BACKLOG_SCAN_ATTEMPTS', '3'))
+# How often checkpoints advanced by live messages are written out
+CHECKPOINT_SAVE_INTERVAL = float(os.getenv('CHECKPOINT_SAVE_INTERVAL', '60'))
+
+SCAN_BATCH_SIZE = 100
+# Seconds before retrying a failed channel scan, times the attempt number
+SCAN_RETRY_DELAY = 5
+
+
+class BacklogScanner:
+    """Validates appeals posted while the bot was offline.
+
+    The ID of the last processed message in each appeal channel is kept as a
+    checkpoint in the guild's `scan` config. On ready/resume every appeal
+    channel is read from its checkpoint onward in batches, and invalid appeals
+    are removed with bulk delete. Until the scan is done, live messages and
+    the scan claim the messages they check, so one replayed on resume or
+    posted mid-scan is only handled once. While a channel is being scanned
+    its saved checkpoint only follows the scan, so a restart mid-scan picks
+    up the backlog where the scan stopped rather than after the newest live
+    message.
+    """
+
+    def __init__(self, bot, workers=BACKLOG_SCAN_WORKERS, limit=BACKLOG_SCAN_LIMIT):
+        self.bot = bot
+        self.workers = workers
+        self.limit = limit
+        # guild_id -> {channel_id: last processed message ID}
+        self._checkpoints = {}
+        # Checkpoints as they were when the gateway connection dropped
+        self._resume_from = None
+        # Nothing is saved before the first scan has picked its start points
+        self._started = False
+        self._dirty = set()
+        # channel_id -> last message ID the scan has processed, for channels
+        # whose scan hasn't finished; these are what gets saved for them
+        self._scan_positions = {}
+        self._running = False
+        # Set when a resume comes in during a scan, which then runs once more
+        self._rescan = False
+        # (guild_id, author_id) -> role IDs fetched during the current scan
+        self._author_roles = {}
+        # Message IDs already checked, kept from the drop until the scan has
+        # caught up. It starts out as a set because the startup scan is due,
+        # and is None between scans, when only live messages are checked
+        self._claimed = set()
+        self.scanned = 0
+        self.rejected = 0
+
+    def mark(self, guild_id, channel_id, message_id):
+        channels = self._checkpoints.get(guild_id)
+        if channels is None:
+            channels = self._checkpoints[guild_id] = {}
+        if message_id > channels.get(channel_id, 0):
+            channels[channel_id] = message_id
+            self._dirty.add(guild_id)
+
+    def claim(self, message_id):
+        """Whether a message still has to be checked, claiming it if so."""
+        if self._claimed is None:
+            return True
+        if message_id in self._claimed:
+            return False
+        self._claimed.add(message_id)
+        return True
+
+    def snapshot(self):
+        if self._claimed is None:
+            self._claimed = set()
+        # Live messages keep moving the checkpoints once we're back, so
+        # remember where each channel stood when the connection dropped
+        if self._resume_from is None:
+            self._resume_from = {guild_id: self._saved_positions(guild_id) for guild_id in self._checkpoints}
+
+    def _saved_positions(self, guild_id):
+        # Channels still being scanned stand where the scan is, not where
+        # live messages have got to
+        return {
+            channel_id: self._scan_positions.get(channel_id, message_id)
+            for channel_id, message_id in self._checkpoints[guild_id].items()
+        }
+
+    def _start_point(self, guild_id, channel_id, resume_from):
+        if resume_from is not None and channel_id in resume_from.get(guild_id, {}):
+            return resume_from[guild_id][channel_id]
+        return load_config(guild_id, 'scan').get('channels', {}).get(str(channel_id))
+
+    def save_checkpoints(self):
+        if not self._started:
+            return
+        dirty, self._dirty = self._dirty, set()
+        for guild_id in dirty:
+            config = load_config(guild_id, 'scan')
+            channels = config.setdefault('channels', {})
+            for channel_id, message_id in self._saved_positions(guild_id).items():
+                if message_id > channels.get(str(channel_id), 0):
+                    channels[str(channel_id)] = message_id
+            save_config(guild_id, 'scan', config)
+
+    async def save_periodically(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_SAVE_INTERVAL)
+            self.save_checkpoints()
+
+    async def scan_all(self):
+        if self._running:
+            # Let the running scan go round again for what this resume missed
+            self._rescan = True
+            return
+        self._running = True
+        try:
+            while True:
+                self._rescan = False
+                await self._scan_once()
+                if not self._rescan:
+                    break
+        finally:
+            self._running = False
+            self._author_roles.clear()
+            # Caught up: from here on only live messages are checked
+            self._claimed = None
+
+    async def _scan_once(self):
+        semaphore = asyncio.Semaphore(self.workers)
+        # Decide every start point before any checkpoint gets saved
+        resume_from, self._resume_from = self._resume_from, None
+        # Cluster workers only scan the guilds on their own shards
+        channels = [
+            (channel_id, guild_id) for channel_id, guild_id in appeal_channels.items()
+            if self.bot.get_guild(guild_id) is not None
+        ]
+        start_points = {
+            channel_id: self._start_point(guild_id, channel_id, resume_from)
+            for channel_id, guild_id in channels
+        }
+        for channel_id, guild_id in channels:
+            if start_points[channel_id] is not None:
+                self._scan_positions[channel_id] = start_points[channel_id]
+                self.mark(guild_id, channel_id, start_points[channel_id])
+        self._started = True
+
+        async def scan(channel_id, guild_id):
+            for attempt in range(1, BACKLOG_SCAN_ATTEMPTS + 1):
+                async with semaphore:
+                    # A retry carries on from where the failed attempt got to
+                    after = self._scan_positions.get(channel_id, start_points[channel_id])
+                    try:
+                        await self.scan_channel(guild_id, channel_id, after)
+                        break
+                    except discord.HTTPException as e:
+                        logger.warning(f"Error scanning appeal channel {channel_id} "
+                                       f"(attempt {attempt} of {BACKLOG_SCAN_ATTEMPTS}): {e}")
+                if attempt < BACKLOG_SCAN_ATTEMPTS:
+                    await asyncio.sleep(SCAN_RETRY_DELAY * attempt)
+            else:
+                # Holding the checkpoint back for good would have every later
+                # scan re-read an ever longer range, so the rest is skipped
+                logger.error(f"Giving up on the backlog of appeal channel {channel_id} "
+                             f"after {self._scan_positions.get(channel_id)}")
+            # Live messages move the saved checkpoint again
+            if self._scan_positions.pop(channel_id, None) is not None:
+                self._dirty.add(guild_id)
+
+        await asyncio.gather(*(scan(channel_id, guild_id) for channel_id, guild_id in channels))
+        self.save_checkpoints()
+        logger.info(f"Backlog scan of {len(channels)} appeal channels done "
+                    f"({self.scanned} messages checked, {self.rejected} rejected so far)")
+
+    async def scan_channel(self, guild_id, channel_id, after):
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(channel_id) if guild else None
+        if channel is None:
+            return
+
+        if after is None:
+            # Never seen this channel: start from its newest message instead
+            # of sweeping appeals posted before the bot was watching it
+            if channel.last_message_id:
+                self.mark(guild_id, channel_id, channel.last_message_id)
+            return
+
+        while True:
+            batch = []
+            read = 0
+            async for message in channel.history(after=discord.Object(id=after), oldest_first=True, limit=self.limit):
+                batch.append(message)
+                read += 1
+                after = message.id
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    await self._process_batch(guild, channel, batch)
+                    batch = []
+            if batch:
+                await self._process_batch(guild, channel, batch)
+            # Live messages move the checkpoint past anything left unread, so
+            # a full page means reading on until the channel's newest message
+            if read < self.limit:
+                return
+            logger.info(f"Appeal channel {channel_id} has more than {self.limit} messages to catch up on, "
+                        f"reading on from {after}")
+
+    async def _process_batch(self, guild, channel, batch):
+        config = channel_settings.get(channel.id, peek_config(guild.id, 'format'))
+        rejections = []
+        # A valid appeal only has something to act on when repeats are handled
+        check_repeats = config.get('duplicate_steam_id_action', 'off') in ('flag', 'reject')
+        for message in batch:
+            if message.author.bot or not self.claim(message.id):
+                continue
+            result = validate_appeal(channel.id, config, message.content)
+            if result.valid and not result.steam_id:
+                continue
+            # Whitelisted authors are left alone, as they are live
+            fetch = not result.valid or check_repeats
+            if await self._is_exempt(guild, channel, config, message.author, fetch):
+                continue
+            if result.valid:
+                # Repeat appeals get the same duplicate handling as live ones
+                await self.bot.index_appeal(message, config, result.steam_id)
+                continue
+            log_reason, dm_text = self.bot.describe_rejection(message, config, result)
+            rejections.append((message, log_reason, dm_text, result.reason, result.field))
+
+        self.scanned += len(batch)
+        if rejections:
+            self.rejected += len(rejections)
+            await enforcement.enforce_bulk(channel, rejections, log_channel=self.bot.get_log_channel(guild))
+        self.mark(guild.id, channel.id, batch[-1].id)
+        if channel.id in self._scan_positions:
+            self._scan_positions[channel.id] = batch[-1].id
+        self.save_checkpoints()
+
+    async def _is_exempt(self, guild, channel, config, author, fetch):
+        """Whether an author's roles exempt their message.
+
+        History payloads carry no member data. An author who isn't cached is
+        only fetched when `fetch` says their roles decide what happens to the
+        message, and at most once per scan.
+        """
+        whitelist = role_whitelists.get(channel.id, config)
+        if not whitelist:
+            return False
+        role_ids = getattr(author, '_roles', None)
+        if role_ids is None:
+            member = guild.get_member(author.id)
+            if member is not None:
+                role_ids = member_role_ids(member)
+            else:
+                role_ids = self._author_roles.get((guild.id, author.id))
+        if role_ids is None:
+            if not fetch:
+                return False
+            try:
+                member = await guild.fetch_member(author.id)
+            except discord.NotFound:
+                # Gone from the server, so there are no roles to exempt them
+                role_ids = ()
+            except discord.HTTPException:
+                # Rather keep an appeal than delete a moderator's message
+                return True
+            else:
+                role_ids = member_role_ids(member)
+            self._author_roles[(guild.id, author.id)] = role_ids
+        return not whitelist.isdisjoint(role_ids)
@@ -0,0 +1,231 @@
+"""Offline benchmark for the appeal checks run by `on_message`.
+
+Generates synthetic appeal corpora and pushes them through the same
+whitelist, format and Steam ID checks the bot uses, with no network or
+Discord token. Results are written as JSON so runs can be compared:
+
+    python bench.py --output bench.json
+    python bench.py --compare bench.json
+"""
+import gc
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import subprocess
+from validation import DEFAULT_MESSAGE_FORMAT, check_appeal, verdict_cache
+
+NAMES = ['Max Verstappen', 'Ayrton', 'driver_42', 'Kimi R', 'slowpoke']
+UNICODE_NAMES = ['Jürgen Größe', 'Łukasz Żółw', '佐藤 太郎', 'Андрей', 'Δημήτρης 🏎️', 'Zoë 🚀✨']
+WORDS = ['banned', 'for', 'ramming', 'wasn\'t', 'me', 'lag', 'sorry', 'please', 'unban', 'server', 'race', 'lap']
+UNICODE_WORDS = ['ごめんなさい', 'пожалуйста', 'désolé', '🙏', 'λάθος', 'straße', '🏁']
+
+
+def steam_id(rng):
+    # 76561198... and 76561199... are always inside the individual account range
+    return '7656119' + rng.choice('89') + ''.join(rng.choice(string.digits) for _ in range(9))
+
+
+def details(rng, words, lines):
+    return '\n'.join(' '.join(rng.choice(words) for _ in range(rng.randint(3, 15))) for _ in range(lines))
+
+
+def appeal(rng, name, sid, body):
+    return f"AC Driver Name: {name}\nSteam ID: {sid}\nDetails: {body}"
+
+
+def corpus_valid(rng, count):
+    for _ in range(count):
+        yield appeal(rng, rng.choice(NAMES), steam_id(rng), details(rng, WORDS, 1)), ()
+
+
+def corpus_malformed(rng, count):
+    for _ in range(count):
+        lines = appeal(rng, rng.choice(NAMES), steam_id(rng), details(rng, WORDS, 1)).split('\n')
+        kind = rng.randrange(4)
+        if kind == 0:
+            del lines[rng.randrange(len(lines))]
+        elif kind == 1:
+            rng.shuffle(lines)
+        elif kind == 2:
+            lines = [line.lower() for line in lines]
+        else:
+            lines = [details(rng, WORDS, 1)]
+        yield '\n'.join(lines), ()
+
+
+def corpus_bad_steam_id(rng, count):
+    bad = ['123', 'STEAM_0:1:12345', '76561198', 'https://steamcommunity.com/id/someone', '7656119' + 'x' * 10,
+           '76561190000000000', '76561197960265728']
+    for _ in range(count):
+        yield appeal(rng, rng.choice(NAMES), rng.choice(bad), details(rng, WORDS, 1)), ()
+
+
+def corpus_huge_details(rng, count):
+    for _ in range(count):
+        # Discord caps messages at 4000 characters for Nitro users
+        yield appeal(rng, rng.choice(NAMES), steam_id(rng), details(rng, WORDS, 60))[:4000], ()
+
+
+def corpus_unicode(rng, count):
+    for _ in range(count):
+        body = details(rng, UNICODE_WORDS + WORDS, rng.randint(1, 5))
+        yield appeal(rng, rng.choice(UNICODE_NAMES), steam_id(rng), body).replace('\n', '\r\n', rng.randrange(2)), ()
+
+
+def corpus_many_roles(rng, count):
+    for _ in range(count):
+        roles = tuple(rng.getrandbits(60) for _ in range(250))
+        yield appeal(rng, rng.choice(NAMES), steam_id(rng), details(rng, WORDS, 1)), roles
+
+
+def corpus_whitelisted(rng, count):
+    for _ in range(count):
+        roles = tuple(rng.getrandbits(60) for _ in range(20)) + (1,)
+        yield details(rng, WORDS, 2), roles
+
+
+def corpus_tolerant(rng, count):
+    for _ in range(count):
+        content = appeal(rng, rng.choice(NAMES), steam_id(rng), details(rng, WORDS, 1))
+        yield content.replace('AC Driver Name', 'ac   driver name').replace('Steam ID', ' STEAM id'), ()
+
+
+def corpus_reposts(rng, count):
+    # A few bad appeals posted over and over, as rejected users tend to
+    texts = [content for content, _ in corpus_malformed(rng, 20)]
+    for _ in range(count):
+        yield rng.choice(texts), ()
+
+
+def long_whitelist(rng):
+    return [rng.getrandbits(60) for _ in range(1000)]
+
+
+# name -> (corpus generator, format config builder)
+CORPORA = {
+    'valid': (corpus_valid, lambda rng: {}),
+    'malformed': (corpus_malformed, lambda rng: {}),
+    'bad_steam_id': (corpus_bad_steam_id, lambda rng: {}),
+    'huge_details': (corpus_huge_details, lambda rng: {}),
+    'unicode': (corpus_unicode, lambda rng: {}),
+    'many_roles': (corpus_many_roles, lambda rng: {"whitelisted_roles": [rng.getrandbits(60) for _ in range(10)]}),
+    'long_whitelist': (corpus_many_roles, lambda rng: {"whitelisted_roles": long_whitelist(rng)}),
+    'whitelisted': (corpus_whitelisted, lambda rng: {"whitelisted_roles": long_whitelist(rng) + [1]}),
+    'tolerant': (corpus_tolerant, lambda rng: {"format_ignore_case": True, "format_tolerant_whitespace": True}),
+    'reposts': (corpus_reposts, lambda rng: {}),
+}
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_corpus(name, count, seed, channel_id):
+    rng = random.Random(f"{seed}:{name}")
+    generate, build_config = CORPORA[name]
+    format_config = {"message_format": DEFAULT_MESSAGE_FORMAT, "whitelisted_roles": []}
+    format_config.update(build_config(rng))
+    messages = list(generate(rng, count))
+
+    # Warm up so the validator and whitelist set are already built
+    for content, role_ids in messages[:100]:
+        check_appeal(channel_id, format_config, content, role_ids)
+    # but not the verdicts, or the warm-up messages would be timed as repost hits
+    verdict_cache.clear()
+
+    outcomes = {"valid": 0, "format": 0, "steam_id": 0, "exempt": 0}
+    timings = []
+    clock = time.perf_counter_ns
+    gc.disable()
+    try:
+        total_start = clock()
+        for content, role_ids in messages:
+            start = clock()
+            result = check_appeal(channel_id, format_config, content, role_ids)
+            timings.append(clock() - start)
+            if result is None:
+                outcomes["exempt"] += 1
+            else:
+                outcomes[result.reason or "valid"] += 1
+        total = clock() - total_start
+    finally:
+        gc.enable()
+
+    timings.sort()
+    return {
+        "corpus": name,
+        "messages": count,
+        "messages_per_second": round(count / (total / 1e9)),
+        "p50_us": round(percentile(timings, 0.50) / 1000, 3),
+        "p99_us": round(percentile(timings, 0.99) / 1000, 3),
+        "outcomes": outcomes,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as file:
+        baseline = {entry["corpus"]: entry for entry in json.load(file)["results"]}
+    print(f"{'corpus':<16}{'msg/s':>12}{'baseline':>12}{'change':>10}", file=sys.stderr)
+    for entry in results:
+        old = baseline.get(entry["corpus"])
+        if old is None:
+            continue
+        change = entry["messages_per_second"] / old["messages_per_second"] - 1
+        print(f"{entry['corpus']:<16}{entry['messages_per_second']:>12}{old['messages_per_second']:>12}{change:>+10.1%}",
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ban appeal checks offline")
+    parser.add_argument('--messages', type=int, default=20000, help="Messages per corpus (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the synthetic corpora (default: %(default)s)")
+    parser.add_argument('--corpus', action='append', choices=sorted(CORPORA), help="Only run these corpora")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    parser.add_argument('--compare', metavar='BASELINE', help="Print throughput changes against an earlier JSON result")
+    args = parser.parse_args()
+
+    names = args.corpus or list(CORPORA)
+    results = []
+    for channel_id, name in enumerate(names, start=1):
+        entry = run_corpus(name, args.messages, args.seed, channel_id)
+        results.append(entry)
+        print(f"{name:<16}{entry['messages_per_second']:>10} msg/s  "
+              f"p50 {entry['p50_us']:>8.2f}us  p99 {entry['p99_us']:>8.2f}us", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "messages_per_corpus": args.messages,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
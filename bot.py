@@ -1,12 +1,24 @@
 import os
+import sys
 import discord
 import json
-import re
 import logging
 import asyncio
+import signal
+import math
+import time
+import hashlib
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
+from config_store import CONFIG_DIR, APPEAL_INDEX_REFRESH, load_config, save_config, peek_config, appeal_channels, channel_settings, config_cache, config_writer, prepare_backend
+from validation import DEFAULT_MESSAGE_FORMAT, format_validators, role_whitelists, verdict_cache, validate_appeal, is_valid_steam_id
+from enforcement import enforcement, member_role_ids
+from backlog import BacklogScanner
+from appeal_index import steam_id_index, DEFAULT_DUPLICATE_WINDOW_DAYS
+from metrics import metrics
+from audit_log import audit_log
+import diagnostics
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,6 +31,24 @@ intents.guilds = True
 intents.members = True
 intents.message_content = True
 
+# Low-memory mode: appeals carry the author's role IDs, which is all the
+# whitelist check needs, so members aren't chunked or cached and there is no
+# message cache
+LOW_MEMORY = os.getenv('LOW_MEMORY', '').lower() in ('1', 'true', 'yes', 'on')
+# Messages kept in discord.py's message cache; 0 turns it off
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', '0' if LOW_MEMORY else '1000'))
+
+# Sharding: unset, discord.py asks Discord for the recommended shard count and
+# runs every shard in this process. cluster.py sets these for each worker.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id] or None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+# When the cluster started and how many shards may identify per 5 seconds,
+# so workers can take turns identifying
+CLUSTER_START = float(os.getenv('CLUSTER_START', '0'))
+IDENTIFY_CONCURRENCY = int(os.getenv('IDENTIFY_CONCURRENCY', '1'))
+IDENTIFY_INTERVAL = 5.5
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -26,24 +56,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger('discord')
 
-# Helper functions
-def load_config(guild_id, config_type):
-    config_path = f'config/{guild_id}/{config_type}.json'
-    if os.path.exists(config_path):
-        with open(config_path, 'r') as file:
-            return json.load(file)
-    return {}
-
-def save_config(guild_id, config_type, config):
-    config_path = f'config/{guild_id}/{config_type}.json'
-    os.makedirs(os.path.dirname(config_path), exist_ok=True)
-    with open(config_path, 'w') as file:
-        json.dump(config, file, indent=4)
-
-def is_valid_steam_id(steam_id):
-    steam_id64_pattern = re.compile(r'^7656\d{13}$')
-    return steam_id64_pattern.match(steam_id)
+# Reaction added to appeals flagged as repeats of an earlier one
+REPEAT_APPEAL_EMOJI = '🔁'
+
+# Seconds to wait for more edits of the same appeal before revalidating it
+EDIT_DEBOUNCE = float(os.getenv('EDIT_DEBOUNCE', '2'))
+
+# Seconds a /setup session may take before it expires without saving anything
+SETUP_SESSION_TIMEOUT = float(os.getenv('SETUP_SESSION_TIMEOUT', '900'))
+
+# Hash of the last command tree synced to Discord, kept with the configs
+COMMAND_HASH_PATH = os.path.join(CONFIG_DIR, 'command_tree.hash')
+# Set to sync the command tree even when it hasn't changed
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC', '').lower() in ('1', 'true', 'yes', 'on')
 
+# Helper functions
 def initialize_config(guild_id):
     format_config = {
         "ban_appeal_channel_id": None,
@@ -71,41 +98,148 @@ def initialize_config(guild_id):
     existing_error = load_config(guild_id, 'error')
     existing_logs = load_config(guild_id, 'logs')
     
-    # Merge existing configs with new defaults, without modifying existing ones
-    if existing_format:
-        save_config(guild_id, 'format', existing_format)
-    else:
+    # Only write defaults for configs that don't exist yet
+    if not existing_format:
         save_config(guild_id, 'format', format_config)
         
-    if existing_error:
-        save_config(guild_id, 'error', existing_error)
-    else:
+    if not existing_error:
         save_config(guild_id, 'error', error_config)
         
-    if existing_logs:
-        save_config(guild_id, 'logs', existing_logs)
-    else:
+    if not existing_logs:
         save_config(guild_id, 'logs', logs_config)
 
-class CustomBot(commands.Bot):
+def command_tree_hash(tree, application_id):
+    # The same payload tree.sync() sends, in a stable order
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command['name'])
+    data = json.dumps({"application_id": application_id, "commands": payload}, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def read_command_hash():
+    try:
+        with open(COMMAND_HASH_PATH, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def write_command_hash(tree_hash):
+    os.makedirs(os.path.dirname(COMMAND_HASH_PATH), exist_ok=True)
+    with open(COMMAND_HASH_PATH, 'w') as file:
+        file.write(tree_hash + '\n')
+
+class CustomBot(commands.AutoShardedBot):
     def __init__(self):
         logger.info("Initializing bot...")
+        options = {}
+        if LOW_MEMORY:
+            options.update(chunk_guilds_at_startup=False, member_cache_flags=discord.MemberCacheFlags.none())
         super().__init__(
             command_prefix=commands.when_mentioned,
-            intents=intents
+            intents=intents,
+            max_messages=MESSAGE_CACHE_SIZE or None,
+            shard_count=SHARD_COUNT,
+            shard_ids=SHARD_IDS,
+            **options
         )
         self.reconnect_attempts = 0
+        self.backlog_scanner = BacklogScanner(self)
+        # Message ID -> newest version of an edited appeal waiting out EDIT_DEBOUNCE
+        self.pending_edits = {}
         self.tree.on_error = self.on_app_command_error
+        if LOW_MEMORY:
+            logger.info("Low-memory mode: member chunking and caching are off")
         logger.info("Bot initialized successfully")
 
     async def setup_hook(self):
         logger.info("Setting up bot...")
+        prepare_backend()
+        appeal_channels.rebuild()
+        # Docker stops containers with SIGTERM; shut down cleanly so pending
+        # config writes are flushed
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: asyncio.create_task(self.close())
+            )
+        except NotImplementedError:
+            pass
+        self.loop.create_task(self.backlog_scanner.save_periodically())
+        if APPEAL_INDEX_REFRESH:
+            self.loop.create_task(appeal_channels.refresh_periodically())
+        diagnostics.enable(self.loop)
+        audit_log.start()
+        self.setup_metrics()
+        await metrics.start()
+        await self.sync_command_tree()
+
+    async def sync_command_tree(self):
+        # Commands are global, so one cluster worker syncing them is enough
+        if CLUSTER_ID != 0:
+            return
+        # Syncing is a heavily rate-limited global call, so skip it when the
+        # commands are the same as last time
+        tree_hash = command_tree_hash(self.tree, self.application_id)
+        if not FORCE_COMMAND_SYNC and read_command_hash() == tree_hash:
+            logger.info("Command tree unchanged, skipping sync")
+            return
         try:
             await self.tree.sync()
             logger.info("Command tree synced successfully")
         except Exception as e:
             logger.error(f"Error syncing command tree: {e}")
             raise
+        try:
+            write_command_hash(tree_hash)
+        except OSError as e:
+            logger.warning(f"Could not save the command tree hash: {e}")
+
+    def setup_metrics(self):
+        metrics.collect(
+            'ban_appeal_gateway_latency_seconds', "Gateway heartbeat latency", 'gauge',
+            lambda: self.latency if math.isfinite(self.latency) else None
+        )
+        metrics.collect(
+            'ban_appeal_shard_latency_seconds', "Gateway heartbeat latency per shard", 'gauge',
+            lambda: {str(shard_id): latency for shard_id, latency in self.latencies if math.isfinite(latency)}
+        )
+        metrics.collect('ban_appeal_guilds', "Guilds the bot is in", 'gauge', lambda: len(self.guilds))
+        metrics.collect('ban_appeal_appeal_channels', "Configured ban appeal channels", 'gauge', lambda: len(appeal_channels))
+        metrics.collect_stats('ban_appeal_config_cache', "Config cache", config_cache.stats)
+        metrics.collect_stats('ban_appeal_config_writer', "Config writer", config_writer.stats)
+        metrics.collect_stats('ban_appeal_enforcement', "Enforcement pipeline", enforcement.stats)
+        metrics.collect_stats('ban_appeal_verdict_cache', "Appeal verdict cache", verdict_cache.stats)
+        metrics.collect_stats('ban_appeal_flood_limiter', "Appeal channel flood limiter", enforcement.flood_limiter.stats)
+        metrics.collect_stats('ban_appeal_deletion_log', "Deletion log reporter", enforcement.log_reporter.stats)
+        metrics.collect_stats('ban_appeal_steam_id_index', "Steam ID appeal index", steam_id_index.stats)
+        metrics.collect_stats('ban_appeal_audit_log', "Audit log writer", audit_log.stats)
+        if diagnostics.DIAGNOSTICS:
+            metrics.collect_stats('ban_appeal_loop_stall', "Event loop stall detector", diagnostics.stall_detector.stats)
+
+    async def before_identify_hook(self, shard_id, *, initial=False):
+        if CLUSTER_START and shard_id is not None:
+            # Every worker starts identifying at once; give each group of
+            # IDENTIFY_CONCURRENCY shards its own slot instead
+            delay = CLUSTER_START + shard_id // IDENTIFY_CONCURRENCY * IDENTIFY_INTERVAL - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                return
+        await super().before_identify_hook(shard_id, initial=initial)
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        if metrics.enabled:
+            elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+            metrics.command_seconds.observe(elapsed, command.qualified_name)
+            metrics.commands.inc(command.qualified_name, 'ok')
+
+    async def close(self):
+        await metrics.stop()
+        diagnostics.stall_detector.stop()
+        logger.info("Flushing pending deletion logs and config writes...")
+        self.backlog_scanner.save_checkpoints()
+        await enforcement.flush_floods()
+        await enforcement.log_reporter.flush()
+        await steam_id_index.flush()
+        await config_writer.flush()
+        await asyncio.to_thread(audit_log.stop)
+        await super().close()
         
     async def on_ready(self):
         try:
@@ -132,33 +266,43 @@ class CustomBot(commands.Bot):
                 scopes=("bot", "applications.commands")
             )
             
-            # Force print to console
-            with open('/dev/stdout', 'w') as console:
-                console.write("\n" + "="*50 + "\n")
-                console.write("Bot is ready!\n")
-                console.write("-"*50 + "\n")
-                console.write(f"Bot Name: {self.user}\n")
-                console.write(f"Bot ID: {self.user.id}\n")
-                console.write("-"*50 + "\n")
-                console.write("Invite Link:\n")
-                console.write(f"{invite_link}\n")
-                console.write("-"*50 + "\n")
-                console.write(f"Required Permissions: {permissions.value}\n")
-                console.write("="*50 + "\n\n")
-                console.flush()
+            # Force print to console (sys.stdout rather than reopening
+            # /dev/stdout, which blocks the loop and is missing in some containers)
+            console = sys.stdout
+            console.write("\n" + "="*50 + "\n")
+            console.write("Bot is ready!\n")
+            console.write("-"*50 + "\n")
+            console.write(f"Bot Name: {self.user}\n")
+            console.write(f"Bot ID: {self.user.id}\n")
+            console.write("-"*50 + "\n")
+            console.write("Invite Link:\n")
+            console.write(f"{invite_link}\n")
+            console.write("-"*50 + "\n")
+            console.write(f"Required Permissions: {permissions.value}\n")
+            console.write("="*50 + "\n\n")
+            console.flush()
             
             logger.info("Bot setup completed successfully")
         except Exception as e:
             logger.error(f"Error in on_ready: {e}")
             raise
+        # Catch up on appeals posted while we were offline
+        asyncio.create_task(self.backlog_scanner.scan_all())
+
+    async def on_resumed(self):
+        asyncio.create_task(self.backlog_scanner.scan_all())
 
     async def on_disconnect(self):
+        self.backlog_scanner.snapshot()
         self.reconnect_attempts += 1
         wait_time = min(2 ** self.reconnect_attempts, 60)
         logger.warning(f'Disconnected from Discord. Attempting to reconnect in {wait_time} seconds...')
         await asyncio.sleep(wait_time)
 
     async def on_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        if metrics.enabled:
+            command_name = interaction.command.qualified_name if interaction.command else 'unknown'
+            metrics.commands.inc(command_name, type(error).__name__)
         try:
             if isinstance(error, app_commands.CommandOnCooldown):
                 await interaction.response.send_message(
@@ -180,83 +324,246 @@ class CustomBot(commands.Bot):
             logger.error(f"Error handling command error: {e}")
 
     async def on_message(self, message: discord.Message):
+        start = metrics.now()
+        # Check if message is in ban appeal channel (also drops DMs)
+        if message.channel.id not in appeal_channels:
+            if metrics.enabled:
+                metrics.stage('channel_filter', start)
+                metrics.messages.inc('ignored')
+            return
+        start = metrics.stage('channel_filter', start)
+
+        self.backlog_scanner.mark(message.guild.id, message.channel.id, message.id)
         if message.author.bot:
+            metrics.count(metrics.messages, 'bot')
+            return
+        # Replayed on resume or already checked by the backlog scan
+        if not self.backlog_scanner.claim(message.id):
+            metrics.count(metrics.messages, 'duplicate')
             return
+        await self.check_appeal(message, start, metrics.messages)
 
-        # Check if message is in ban appeal channel
-        config = load_config(message.guild.id, 'format')
-        if message.channel.id != config.get('ban_appeal_channel_id'):
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        # Driven by the payload alone, so edits are caught without a message cache
+        if payload.channel_id not in appeal_channels:
             return
+        # Embed unfurls also arrive as updates but leave edited_timestamp unset
+        if not payload.data.get('edited_timestamp') or payload.message.author.bot:
+            return
+        first_edit = payload.message_id not in self.pending_edits
+        self.pending_edits[payload.message_id] = payload.message
+        if first_edit:
+            self.loop.create_task(self.revalidate_edit(payload.message_id))
+        else:
+            metrics.count(metrics.edits, 'debounced')
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        # A message deleted while its edit settles leaves nothing to enforce
+        self.pending_edits.pop(payload.message_id, None)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            self.pending_edits.pop(message_id, None)
+
+    async def revalidate_edit(self, message_id):
+        """Check the newest version of an edited appeal once its edits settle."""
+        await asyncio.sleep(EDIT_DEBOUNCE)
+        message = self.pending_edits.pop(message_id, None)
+        if message is None:
+            metrics.count(metrics.edits, 'deleted')
+            return
+        # The channel may have stopped being an appeal channel in the meantime
+        if message.channel.id not in appeal_channels:
+            return
+        await self.check_appeal(message, metrics.now(), metrics.edits, edited=True)
+
+    async def check_appeal(self, message, start, counter, edited=False):
+        """Validate an appeal and enforce the result, for new and edited messages alike.
+
+        An edited appeal that is still valid is indexed again only when its
+        Steam ID changed, going through the same duplicate check.
+        """
+        # The guild's format config with this channel's overrides applied
+        config = channel_settings.get(message.channel.id, peek_config(message.guild.id, 'format'))
+        start = metrics.stage('config_load', start)
 
         # Check if user has whitelisted role
-        user_roles = [role.id for role in message.author.roles]
-        if not any(role_id in config.get('whitelisted_roles', []) for role_id in user_roles):
-            # Verify format
-            expected_format = config.get('message_format', "AC Driver Name:\nSteam ID:\nDetails:")
-            format_sections = expected_format.split('\n')
-            message_content = message.content.strip()
-            
-            # Check if message follows format
-            format_valid = True
-            steam_id = None
-            
-            try:
-                lines = message_content.split('\n')
-                if len(lines) < len(format_sections):
-                    format_valid = False
-                else:
-                    for i, section in enumerate(format_sections):
-                        if not lines[i].startswith(section.split(':')[0]):
-                            format_valid = False
-                            break
-                        if 'Steam ID' in section:
-                            steam_id = lines[i].split(':', 1)[1].strip()
-            except:
-                format_valid = False
-
-            if not format_valid:
-                error_config = load_config(message.guild.id, 'error')
-                error_msg = (
-                    f"Hi {message.author.mention}, your ban appeal format is incorrect. "
-                    f"Please use the following format:\n```\n{expected_format}```\n"
-                    f"{error_config.get('error_message', '')}"
-                )
-                
-                # Log the deletion
-                logs_config = load_config(message.guild.id, 'logs')
-                if logs_config.get('log_channel_id'):
-                    log_channel = message.guild.get_channel(logs_config['log_channel_id'])
-                    if log_channel:
-                        await log_channel.send(
-                            f"Deleted message from {message.author.mention} for incorrect format.\n"
-                            f"Message content: {message_content}"
-                        )
-                
-                await message.delete()
-                await message.author.send(error_msg)
-                return
+        exempt = role_whitelists.is_exempt(message.channel.id, config, member_role_ids(message.author))
+        start = metrics.stage('whitelist', start)
+        if exempt:
+            metrics.count(counter, 'whitelisted')
+            return
 
-            # Verify Steam ID if format is valid
-            if steam_id and not is_valid_steam_id(steam_id):
-                error_config = load_config(message.guild.id, 'error')
-                
-                # Log the deletion
-                logs_config = load_config(message.guild.id, 'logs')
-                if logs_config.get('log_channel_id'):
-                    log_channel = message.guild.get_channel(logs_config['log_channel_id'])
-                    if log_channel:
-                        await log_channel.send(
-                            f"Deleted message from {message.author.mention} for invalid Steam ID.\n"
-                            f"Message content: {message_content}"
-                        )
-                
-                await message.delete()
-                await message.author.send(error_config.get('steam_id_error_message', ''))
-                return
+        # Users posting faster than the flood limit have their burst removed in one go
+        if not edited and enforcement.flood_limiter.hit(message.guild.id, message.author.id):
+            metrics.count(counter, 'flood')
+            enforcement.collect_flood(message, self.get_log_channel(message.guild))
+            return
+
+        # Format and Steam ID are checked in the same pass, exactly as
+        # validation.check_appeal does for the benchmark and the auditor
+        result = validate_appeal(message.channel.id, config, message.content)
+        metrics.stage('format', start)
+        metrics.count(counter, result.reason or 'valid')
+        if result.valid:
+            if result.steam_id:
+                if edited:
+                    indexed = await steam_id_index.steam_id_for(message.guild.id, message.id)
+                    if indexed == int(result.steam_id):
+                        return
+                    await steam_id_index.forget(message.guild.id, message.id)
+                await self.index_appeal(message, config, result.steam_id)
+            return
+
+        log_reason, error_msg = self.describe_rejection(message, config, result)
+        if edited:
+            log_reason = f"{log_reason} after an edit"
+        await enforcement.enforce(message, log_reason, log_channel=self.get_log_channel(message.guild), dm_text=error_msg,
+                                  rule=result.reason, field=result.field)
+
+    async def index_appeal(self, message, config, steam_id):
+        """Record a valid appeal's Steam ID and act on repeat appeals."""
+        action = config.get('duplicate_steam_id_action', 'off')
+        previous = None
+        if action in ('flag', 'reject'):
+            window = config.get('duplicate_window_days', DEFAULT_DUPLICATE_WINDOW_DAYS)
+            previous = await steam_id_index.find_duplicate(message.guild.id, steam_id, message.id, window)
+        if previous is None:
+            steam_id_index.record(message.guild.id, steam_id, message, 'accepted')
+            return
+
+        if action == 'flag':
+            steam_id_index.record(message.guild.id, steam_id, message, 'flagged')
+            await enforcement.flag(message, REPEAT_APPEAL_EMOJI, reason=f"repeat appeal for Steam ID {steam_id}",
+                                   rule='duplicate')
+            return
+        steam_id_index.record(message.guild.id, steam_id, message, 'rejected')
+        error_msg = self.error_text(message.guild.id, config, 'duplicate_error_message') or (
+            f"Hi {message.author.mention}, an appeal for Steam ID {steam_id} was already posted "
+            f"<t:{int(previous.timestamp)}:R>. Please wait for it to be reviewed instead of posting a new one."
+        )
+        await enforcement.enforce(message, f"repeat appeal for Steam ID {steam_id}",
+                                  log_channel=self.get_log_channel(message.guild), dm_text=error_msg, rule='duplicate')
+
+    def error_text(self, guild_id, config, key):
+        """An appeal channel's own error text, or else the guild's from error.json."""
+        return config.get(key) or peek_config(guild_id, 'error').get(key, '')
+
+    def describe_rejection(self, message, config, result):
+        """Return the log reason and the DM text for a rejected appeal.
+
+        `config` is the appeal channel's settings from `channel_settings`.
+        """
+        if result.reason == 'format':
+            validator = format_validators.get(message.channel.id, config)
+            error_msg = (
+                f"Hi {message.author.mention}, your ban appeal format is incorrect "
+                f"(check the `{result.field}` line). "
+                f"Please use the following format:\n```\n{validator.message_format}```\n"
+                f"{self.error_text(message.guild.id, config, 'error_message')}"
+            )
+            return f"incorrect format ({result.field})", error_msg
+        return "invalid Steam ID", self.error_text(message.guild.id, config, 'steam_id_error_message')
+
+    def get_log_channel(self, guild):
+        logs_config = peek_config(guild.id, 'logs')
+        if logs_config.get('log_channel_id'):
+            return guild.get_channel(logs_config['log_channel_id'])
+        return None
+
+def normalize_format(message_format):
+    """Drop the blank lines and spaces a modal leaves around a format's lines."""
+    return '\n'.join(line.strip() for line in message_format.strip().split('\n'))
+
+def format_problem(message_format):
+    """Return what's wrong with a message format, or None if it can be used.
+
+    The format is checked exactly as it will be compiled, so a blank line or
+    a label with leading spaces is a problem rather than a line no appeal
+    can match.
+    """
+    for line in message_format.split('\n'):
+        label, colon, _ = line.partition(':')
+        if not colon or not label.strip() or label != label.lstrip():
+            return "Every line of the message format needs a label followed by a colon."
+    return None
+
+class SetupSession:
+    """What the setup wizard has collected so far, committed in one go at the end.
+
+    Nothing is written while the wizard runs, so an abandoned or expired
+    session leaves the guild's configs untouched. `commit()` applies the
+    collected values on top of the current configs and writes all three
+    together.
+    """
 
-class ChannelSelectView(discord.ui.View):
+    def __init__(self, guild_id, timeout=SETUP_SESSION_TIMEOUT):
+        self.guild_id = guild_id
+        self.expires_at = time.monotonic() + timeout
+        self.format_config = {}
+        self.error_config = {}
+        self.logs_config = {}
+        self.committed = False
+
+    @property
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    async def check(self, interaction: discord.Interaction):
+        """Return whether the session still takes input, telling the user if not."""
+        if self.committed:
+            await interaction.response.send_message("This setup is already complete. Run /setup to start again.", ephemeral=True)
+            return False
+        if not self.remaining:
+            await interaction.response.send_message("⌛ This setup session has expired. Run /setup to start again.", ephemeral=True)
+            return False
+        return True
+
+    def validate(self, guild):
+        problems = []
+        channel_id = self.format_config.get('ban_appeal_channel_id')
+        if not channel_id or guild.get_channel(channel_id) is None:
+            problems.append("The ban appeal channel no longer exists.")
+        log_channel_id = self.logs_config.get('log_channel_id')
+        if log_channel_id and guild.get_channel(log_channel_id) is None:
+            problems.append("The logs channel no longer exists.")
+        problem = format_problem(self.format_config.get('message_format', DEFAULT_MESSAGE_FORMAT))
+        if problem:
+            problems.append(problem)
+        missing_roles = [str(role_id) for role_id in self.format_config.get('whitelisted_roles', []) if guild.get_role(role_id) is None]
+        if missing_roles:
+            problems.append(f"These roles no longer exist: {', '.join(missing_roles)}")
+        return problems
+
+    async def commit(self):
+        configs = {}
+        for config_type, values in (('format', self.format_config), ('error', self.error_config), ('logs', self.logs_config)):
+            config = load_config(self.guild_id, config_type)
+            for key, value in values.items():
+                if key == 'whitelisted_roles':
+                    # The wizard adds to the whitelist rather than replacing it
+                    existing = config.get('whitelisted_roles', [])
+                    value = existing + [role_id for role_id in value if role_id not in existing]
+                config[key] = value
+            configs[config_type] = config
+        configs = await config_writer.commit(self.guild_id, configs)
+        # Enforcement moves to the new channel as soon as the configs are stored
+        appeal_channels.update(self.guild_id, configs['format'])
+        self.committed = True
+
+class SetupStepView(discord.ui.View):
+    """A setup wizard view; it times out with its session and stops taking input once that's over."""
+
+    def __init__(self, session):
+        super().__init__(timeout=max(session.remaining, 1))
+        self.session = session
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await self.session.check(interaction)
+
+class ChannelSelectView(SetupStepView):
     def __init__(self, parent_view, channel_type: str):
-        super().__init__()
+        super().__init__(parent_view.session)
         self.parent_view = parent_view
         self.channel_type = channel_type
         self.selected_channel = None
@@ -288,19 +595,15 @@ class ChannelSelectView(discord.ui.View):
             return
 
         if self.channel_type == "ban_appeal":
-            config = load_config(interaction.guild.id, 'format')
-            config['ban_appeal_channel_id'] = self.selected_channel.id
-            save_config(interaction.guild.id, 'format', config)
+            self.session.format_config['ban_appeal_channel_id'] = self.selected_channel.id
             await self.parent_view.show_format_setup(interaction)
         else:
-            config = load_config(interaction.guild.id, 'logs')
-            config['log_channel_id'] = self.selected_channel.id
-            save_config(interaction.guild.id, 'logs', config)
-            await interaction.response.send_message("✅ Setup complete!", ephemeral=True)
+            self.session.logs_config['log_channel_id'] = self.selected_channel.id
+            await self.parent_view.finish(interaction)
 
-class RoleSelectView(discord.ui.View):
+class RoleSelectView(SetupStepView):
     def __init__(self, parent_view):
-        super().__init__()
+        super().__init__(parent_view.session)
         self.parent_view = parent_view
         self.selected_roles = []
 
@@ -331,36 +634,19 @@ class RoleSelectView(discord.ui.View):
             await interaction.response.send_message("Please select at least one role!", ephemeral=True)
             return
 
-        config = load_config(interaction.guild.id, 'format')
-        if 'whitelisted_roles' not in config:
-            config['whitelisted_roles'] = []
-        
-        for role in self.selected_roles:
-            if role.id not in config['whitelisted_roles']:
-                config['whitelisted_roles'].append(role.id)
-        
-        save_config(interaction.guild.id, 'format', config)
+        self.session.format_config['whitelisted_roles'] = list(dict.fromkeys(role.id for role in self.selected_roles))
         await self.parent_view.show_error_message_setup(interaction)
 
-class ErrorMessageSetupView(discord.ui.View):
+class ErrorMessageSetupView(SetupStepView):
     def __init__(self, parent_view):
-        super().__init__()
+        super().__init__(parent_view.session)
         self.parent_view = parent_view
 
     @discord.ui.button(label="Accept Default", style=discord.ButtonStyle.primary)
     async def accept_default(self, interaction: discord.Interaction, button: discord.ui.Button):
-        config = load_config(interaction.guild.id, 'error')
-        config['error_message'] = (
-            "To use line breaks in Discord, use Shift + Enter.\n"
-            "You can find your Steam ID at https://steamidfinder.com/ (provide SteamID64 (Dec)) or in the Content Manager. "
-            "Go to Settings > Content Manager > General, and then in front of Steam Profile, you should be able to get your Steam ID."
-        )
-        config['steam_id_error_message'] = (
-            "Your Steam ID is not valid. Please provide a valid SteamID64 (a 17-digit number starting with '7656').\n"
-            "You can find your Steam ID at https://steamidfinder.com/ (provide SteamID64 (Dec)) or in the Content Manager. "
-            "Go to Settings > Content Manager > General, and then in front of Steam Profile, you should be able to get your Steam ID."
-        )
-        save_config(interaction.guild.id, 'error', config)
+        defaults = self.parent_view.error_config
+        self.session.error_config['error_message'] = defaults['error_message']
+        self.session.error_config['steam_id_error_message'] = defaults['steam_id_error_message']
         await self.parent_view.show_channel_select(interaction, "logs")
 
     @discord.ui.button(label="Customize", style=discord.ButtonStyle.secondary)
@@ -384,17 +670,18 @@ class CustomErrorMessageModal(discord.ui.Modal):
         )
         self.add_item(self.error_input)
 
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await self.parent_view.session.check(interaction)
+
     async def on_submit(self, interaction: discord.Interaction):
-        config = load_config(interaction.guild.id, 'error')
-        config['error_message'] = self.error_input.value
-        save_config(interaction.guild.id, 'error', config)
+        self.parent_view.session.error_config['error_message'] = self.error_input.value
         await self.parent_view.show_channel_select(interaction, "logs")
 
-class SetupView(discord.ui.View):
-    def __init__(self):
-        super().__init__()
+class SetupView(SetupStepView):
+    def __init__(self, guild_id):
+        super().__init__(SetupSession(guild_id))
         self.current_step = 0
-        # Initialize default configs
+        # Defaults the wizard offers; choices are collected in self.session
         self.format_config = {
             "ban_appeal_channel_id": None,
             "whitelisted_roles": [],
@@ -453,16 +740,29 @@ class SetupView(discord.ui.View):
         view = ErrorMessageSetupView(self)
         await interaction.response.edit_message(embed=embed, view=view)
 
-class FormatView(discord.ui.View):
+    async def finish(self, interaction: discord.Interaction):
+        problems = self.session.validate(interaction.guild)
+        if problems:
+            await interaction.response.send_message(
+                "❌ Nothing was saved:\n" + "\n".join(problems) + "\nRun /setup to start again.", ephemeral=True
+            )
+            return
+        try:
+            await self.session.commit()
+        except Exception as e:
+            logger.error(f"Error saving setup for guild {interaction.guild.id}: {e}")
+            await interaction.response.send_message("❌ The setup could not be saved, please try again.", ephemeral=True)
+            return
+        await interaction.response.send_message("✅ Setup complete!", ephemeral=True)
+
+class FormatView(SetupStepView):
     def __init__(self, parent_view):
-        super().__init__()
+        super().__init__(parent_view.session)
         self.parent_view = parent_view
 
     @discord.ui.button(label="Accept Default", style=discord.ButtonStyle.primary)
     async def accept_default(self, interaction: discord.Interaction, button: discord.ui.Button):
-        config = load_config(interaction.guild.id, 'format')
-        config['message_format'] = "AC Driver Name:\nSteam ID:\nDetails:"
-        save_config(interaction.guild.id, 'format', config)
+        self.session.format_config['message_format'] = self.parent_view.format_config['message_format']
         await self.show_role_setup(interaction)
 
     @discord.ui.button(label="Customize", style=discord.ButtonStyle.secondary)
@@ -490,11 +790,86 @@ class CustomFormatModal(discord.ui.Modal):
         )
         self.add_item(self.format_input)
 
+    async def interaction_check(self, interaction: discord.Interaction):
+        return await self.view.session.check(interaction)
+
+    async def on_submit(self, interaction: discord.Interaction):
+        message_format = normalize_format(self.format_input.value)
+        problem = format_problem(message_format)
+        if problem:
+            await interaction.response.send_message(f"❌ {problem}", ephemeral=True)
+            return
+        self.view.session.format_config['message_format'] = message_format
+        await self.view.show_role_setup(interaction)
+
+class AppealChannelModal(discord.ui.Modal):
+    def __init__(self, channel, format_config):
+        super().__init__(title="Appeal Channel Settings")
+        self.channel = channel
+        overrides = (format_config.get('appeal_channels') or {}).get(str(channel.id)) or {}
+        self.format_input = discord.ui.TextInput(
+            label="Message Format",
+            style=discord.TextStyle.paragraph,
+            default=overrides.get('message_format') or format_config.get('message_format', "AC Driver Name:\nSteam ID:\nDetails:"),
+            required=True
+        )
+        self.roles_input = discord.ui.TextInput(
+            label="Whitelisted Role IDs",
+            placeholder="Separate with spaces; leave empty to use the server's whitelist",
+            default=' '.join(str(role_id) for role_id in overrides.get('whitelisted_roles', [])),
+            required=False
+        )
+        self.error_input = discord.ui.TextInput(
+            label="Error Message",
+            style=discord.TextStyle.paragraph,
+            placeholder="Leave empty to use the server's error message",
+            default=overrides.get('error_message', ''),
+            required=False
+        )
+        self.steam_id_error_input = discord.ui.TextInput(
+            label="Steam ID Error Message",
+            style=discord.TextStyle.paragraph,
+            placeholder="Leave empty to use the server's Steam ID error message",
+            default=overrides.get('steam_id_error_message', ''),
+            required=False
+        )
+        for item in (self.format_input, self.roles_input, self.error_input, self.steam_id_error_input):
+            self.add_item(item)
+
     async def on_submit(self, interaction: discord.Interaction):
+        message_format = normalize_format(self.format_input.value)
+        problem = format_problem(message_format)
+        if problem:
+            await interaction.response.send_message(f"❌ {problem}", ephemeral=True)
+            return
+
+        role_ids = []
+        invalid_roles = []
+        for role_id in self.roles_input.value.split():
+            try:
+                role = interaction.guild.get_role(int(role_id))
+            except ValueError:
+                role = None
+            if role:
+                role_ids.append(role.id)
+            else:
+                invalid_roles.append(role_id)
+        if invalid_roles:
+            await interaction.response.send_message(f"❌ Invalid role IDs: {', '.join(invalid_roles)}", ephemeral=True)
+            return
+
         config = load_config(interaction.guild.id, 'format')
-        config['message_format'] = self.format_input.value
+        overrides = config.setdefault('appeal_channels', {}).setdefault(str(self.channel.id), {})
+        overrides['message_format'] = message_format
+        for key, value in (('whitelisted_roles', role_ids), ('error_message', self.error_input.value),
+                           ('steam_id_error_message', self.steam_id_error_input.value)):
+            if value:
+                overrides[key] = value
+            else:
+                overrides.pop(key, None)
         save_config(interaction.guild.id, 'format', config)
-        await self.view.show_role_setup(interaction)
+        appeal_channels.update(interaction.guild.id, config)
+        await interaction.response.send_message(f"✅ {self.channel.mention} is now a ban appeal channel.", ephemeral=True)
 
 # Create the bot instance first
 logger.info("Starting bot initialization...")
@@ -519,7 +894,7 @@ async def setup(interaction: discord.Interaction):
         color=discord.Color.blue()
     )
     
-    view = SetupView()
+    view = SetupView(interaction.guild.id)
     await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
 
 @bot.tree.command(name="add_roles", description="Add roles to the whitelist")
@@ -536,6 +911,7 @@ async def add_roles(interaction: discord.Interaction, roles: str):
     if 'whitelisted_roles' not in config:
         config['whitelisted_roles'] = []
     
+    whitelisted = set(config['whitelisted_roles'])
     added_roles = []
     already_whitelisted = []
     invalid_roles = []
@@ -544,8 +920,9 @@ async def add_roles(interaction: discord.Interaction, roles: str):
         try:
             role = interaction.guild.get_role(int(role_id))
             if role:
-                if role.id not in config['whitelisted_roles']:
+                if role.id not in whitelisted:
                     config['whitelisted_roles'].append(role.id)
+                    whitelisted.add(role.id)
                     added_roles.append(role.name)
                 else:
                     already_whitelisted.append(role.name)
@@ -580,6 +957,8 @@ async def remove_roles(interaction: discord.Interaction, roles: str):
     if 'whitelisted_roles' not in config:
         config['whitelisted_roles'] = []
     
+    whitelisted = set(config['whitelisted_roles'])
+    to_remove = set()
     removed_roles = []
     not_whitelisted = []
     invalid_roles = []
@@ -589,8 +968,8 @@ async def remove_roles(interaction: discord.Interaction, roles: str):
             role_id = int(role_id)
             role = interaction.guild.get_role(role_id)
             if role:
-                if role_id in config['whitelisted_roles']:
-                    config['whitelisted_roles'].remove(role_id)
+                if role_id in whitelisted and role_id not in to_remove:
+                    to_remove.add(role_id)
                     removed_roles.append(role.name)
                 else:
                     not_whitelisted.append(role.name)
@@ -599,6 +978,7 @@ async def remove_roles(interaction: discord.Interaction, roles: str):
         except ValueError:
             invalid_roles.append(role_id)
     
+    config['whitelisted_roles'] = [role_id for role_id in config['whitelisted_roles'] if role_id not in to_remove]
     save_config(interaction.guild.id, 'format', config)
     
     response = []
@@ -611,10 +991,110 @@ async def remove_roles(interaction: discord.Interaction, roles: str):
     
     await interaction.response.send_message("\n".join(response), ephemeral=True)
 
-# Run the bot last
-logger.info("Running bot...")
-try:
-    bot.run(TOKEN)
-except Exception as e:
-    logger.error(f"Fatal error: {e}")
-    raise
+@bot.tree.command(name="add_appeal_channel", description="Add a ban appeal channel or change its settings")
+@app_commands.default_permissions(administrator=True)
+async def add_appeal_channel(interaction: discord.Interaction, channel: discord.TextChannel):
+    """Watch another channel for appeals, with its own format, whitelist and error messages."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You must be an administrator to use this command.", ephemeral=True)
+        return
+
+    config = load_config(interaction.guild.id, 'format')
+    if config.get('ban_appeal_channel_id') == channel.id:
+        await interaction.response.send_message(
+            f"ℹ️ {channel.mention} is the main ban appeal channel and uses the server's settings. "
+            "Change them with /setup.",
+            ephemeral=True
+        )
+        return
+    await interaction.response.send_modal(AppealChannelModal(channel, config))
+
+@bot.tree.command(name="remove_appeal_channel", description="Stop watching a ban appeal channel")
+@app_commands.default_permissions(administrator=True)
+async def remove_appeal_channel(interaction: discord.Interaction, channel: discord.TextChannel):
+    """Stop watching a channel for appeals and drop its settings."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You must be an administrator to use this command.", ephemeral=True)
+        return
+
+    config = load_config(interaction.guild.id, 'format')
+    removed = (config.get('appeal_channels') or {}).pop(str(channel.id), None) is not None
+    if config.get('ban_appeal_channel_id') == channel.id:
+        config['ban_appeal_channel_id'] = None
+        removed = True
+    if not removed:
+        await interaction.response.send_message(f"ℹ️ {channel.mention} is not a ban appeal channel.", ephemeral=True)
+        return
+
+    save_config(interaction.guild.id, 'format', config)
+    appeal_channels.update(interaction.guild.id, config)
+    await interaction.response.send_message(f"✅ {channel.mention} is no longer a ban appeal channel.", ephemeral=True)
+
+@bot.tree.command(name="lookup_steam_id", description="Show earlier appeals for a Steam ID")
+@app_commands.default_permissions(administrator=True)
+async def lookup_steam_id(interaction: discord.Interaction, steam_id: str):
+    """Show the appeals posted for a SteamID64 in this server, newest first."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You must be an administrator to use this command.", ephemeral=True)
+        return
+
+    steam_id = steam_id.strip()
+    if not is_valid_steam_id(steam_id):
+        await interaction.response.send_message(f"❌ `{steam_id}` is not a valid SteamID64.", ephemeral=True)
+        return
+
+    records = await steam_id_index.lookup(interaction.guild.id, steam_id)
+    if not records:
+        await interaction.response.send_message(f"ℹ️ No appeals found for Steam ID {steam_id}.", ephemeral=True)
+        return
+
+    response = [f"Appeals for Steam ID {steam_id}, newest first:"]
+    for record in records:
+        link = f"https://discord.com/channels/{interaction.guild.id}/{record.channel_id}/{record.message_id}"
+        response.append(f"• <t:{int(record.timestamp)}:f> by <@{record.author_id}> ({record.outcome}): {link}")
+    await interaction.response.send_message("\n".join(response), ephemeral=True)
+
+async def profile(interaction: discord.Interaction, action: app_commands.Choice[str]):
+    """Start or stop the sampling profiler. Only registered in diagnostics mode."""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You must be an administrator to use this command.", ephemeral=True)
+        return
+
+    profiler = diagnostics.profiler
+    if action.value == 'start':
+        if profiler.start():
+            await interaction.response.send_message(
+                f"✅ Profiler started, sampling every {profiler.interval * 1000:g}ms.", ephemeral=True
+            )
+        else:
+            await interaction.response.send_message("ℹ️ The profiler is already running.", ephemeral=True)
+        return
+
+    samples = profiler.stop()
+    if samples is None:
+        await interaction.response.send_message("ℹ️ The profiler isn't running.", ephemeral=True)
+        return
+    path = await asyncio.to_thread(profiler.write, samples)
+    await interaction.response.send_message(
+        f"✅ Profiler stopped after {sum(samples.values())} samples, written to `{path}`.", ephemeral=True
+    )
+
+# The profiler is a process-wide tool, so it's only offered when the operator opts in
+if diagnostics.DIAGNOSTICS:
+    bot.tree.command(name="profile", description="Start or stop the sampling profiler")(
+        app_commands.default_permissions(administrator=True)(
+            app_commands.choices(action=[
+                app_commands.Choice(name="start", value="start"),
+                app_commands.Choice(name="stop", value="stop"),
+            ])(profile)
+        )
+    )
+
+# Run the bot last (importing this module, e.g. from the load test, doesn't)
+if __name__ == '__main__':
+    logger.info("Running bot...")
+    try:
+        bot.run(TOKEN)
+    except Exception as e:
+        logger.error(f"Fatal error: {e}")
+        raise
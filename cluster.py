@@ -0,0 +1,142 @@
+"""Runs the bot as several worker processes, each owning a range of shards.
+
+Discord's recommended shard count is fetched with the bot token unless
+`--shards` is given. The shards are split into contiguous ranges, one per
+worker, and every worker runs `bot.py` with SHARD_COUNT/SHARD_IDS set.
+Workers share the config store (CONFIG_BACKEND=sqlite is recommended) and
+refresh their appeal channel index from it, so a change made through the
+setup wizard in one worker reaches the others within APPEAL_INDEX_REFRESH
+seconds:
+
+    python cluster.py --processes 4
+    python cluster.py --processes 4 --shards 16
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import argparse
+import discord
+from dotenv import load_dotenv
+
+logger = logging.getLogger('cluster')
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+
+def split_shards(shard_count, processes):
+    """Split shard IDs into `processes` contiguous ranges of near-equal size."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (index < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shards(token):
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(token)
+        shard_count, _, session_start_limit = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shard_count, session_start_limit['max_concurrency']
+
+
+def worker_env(cluster_id, shard_ids, shard_count, started_at, max_concurrency):
+    env = dict(
+        os.environ,
+        CLUSTER_ID=str(cluster_id),
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=','.join(map(str, shard_ids)),
+        CLUSTER_START=str(started_at),
+        IDENTIFY_CONCURRENCY=str(max_concurrency),
+    )
+    # Workers have to notice each other's appeal channel changes
+    if not float(env.get('APPEAL_INDEX_REFRESH') or 0):
+        env['APPEAL_INDEX_REFRESH'] = '5'
+    # One metrics port per worker
+    if int(env.get('METRICS_PORT') or 0):
+        env['METRICS_PORT'] = str(int(env['METRICS_PORT']) + cluster_id)
+    return env
+
+
+class Cluster:
+    """Starts the workers, restarts any that exit and stops them all on SIGTERM."""
+
+    def __init__(self, envs):
+        self.envs = envs
+        self._processes = {}
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except NotImplementedError:
+                pass
+        await asyncio.gather(*(self._supervise(cluster_id, env) for cluster_id, env in enumerate(self.envs)))
+
+    async def _supervise(self, cluster_id, env):
+        failures = 0
+        while not self._stopping.is_set():
+            logger.info(f"Starting worker {cluster_id} for shards {env['SHARD_IDS']}")
+            process = await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT, env=env)
+            self._processes[cluster_id] = process
+            started = time.monotonic()
+            returncode = await process.wait()
+            if self._stopping.is_set():
+                break
+            # A worker that ran for a while gets a fresh backoff
+            failures = 1 if time.monotonic() - started > 60 else failures + 1
+            wait_time = min(2 ** failures, 60)
+            logger.warning(f"Worker {cluster_id} exited with code {returncode}, restarting in {wait_time} seconds...")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), wait_time)
+            except asyncio.TimeoutError:
+                pass
+        logger.info(f"Worker {cluster_id} stopped")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run the ban appeal bot as a cluster of sharded processes")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (default: one per CPU, %(default)s)")
+    parser.add_argument('--shards', type=int, help="Total shard count (default: Discord's recommendation)")
+    parser.add_argument('--max-concurrency', type=int,
+                        help="Shards allowed to identify per 5 seconds (default: from Discord)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    shard_count, max_concurrency = args.shards, args.max_concurrency
+    if shard_count is None or max_concurrency is None:
+        recommended, discord_concurrency = await recommended_shards(os.getenv('DISCORD_BOT_TOKEN'))
+        shard_count = shard_count or recommended
+        max_concurrency = max_concurrency or discord_concurrency
+
+    ranges = split_shards(shard_count, args.processes)
+    logger.info(f"Running {shard_count} shards in {len(ranges)} worker processes")
+    started_at = time.time()
+    envs = [
+        worker_env(cluster_id, shard_ids, shard_count, started_at, max_concurrency)
+        for cluster_id, shard_ids in enumerate(ranges)
+    ]
+    await Cluster(envs).run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
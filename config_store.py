@@ -0,0 +1,738 @@
+import os
+import copy
+import contextlib
+import json
+import math
+import time
+import tempfile
+import sqlite3
+import asyncio
+import logging
+import threading
+from validation import format_validators, role_whitelists
+
+logger = logging.getLogger('discord')
+
+CONFIG_DIR = 'config'
+CONFIG_TYPES = ('format', 'error', 'logs', 'scan')
+
+# 'json' keeps one directory of JSON files per guild, 'sqlite' keeps every
+# guild in a single database file
+CONFIG_BACKEND = os.getenv('CONFIG_BACKEND', 'json')
+CONFIG_DB_PATH = os.getenv('CONFIG_DB_PATH', os.path.join(CONFIG_DIR, 'config.db'))
+
+# How long a cached config is trusted before its version is checked again.
+# Hand edits in the mounted config/ volume show up after at most this long.
+CONFIG_CACHE_TTL = float(os.getenv('CONFIG_CACHE_TTL', '5'))
+
+# Repeated saves of the same config within this many seconds become one write
+CONFIG_WRITE_DELAY = float(os.getenv('CONFIG_WRITE_DELAY', '0.5'))
+# Longest wait between retries of a config write that keeps failing
+CONFIG_WRITE_RETRY_MAX = float(os.getenv('CONFIG_WRITE_RETRY_MAX', '60'))
+
+# Seconds between checks for appeal channels changed outside this process
+# (cluster workers, hand edits); 0 turns it off
+APPEAL_INDEX_REFRESH = float(os.getenv('APPEAL_INDEX_REFRESH', '30'))
+
+# Stands in for the version of a cached config whose write hasn't landed yet
+_PENDING = object()
+
+
+def config_path(guild_id, config_type):
+    return os.path.join(CONFIG_DIR, str(guild_id), f'{config_type}.json')
+
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class JsonConfigBackend:
+    """One directory per guild holding format.json, error.json and logs.json.
+
+    The version of a config is its file mtime, so hand edits are noticed.
+    """
+
+    name = 'json'
+
+    def version(self, guild_id, config_type):
+        return _file_mtime(config_path(guild_id, config_type))
+
+    def read(self, guild_id, config_type):
+        path = config_path(guild_id, config_type)
+        mtime = _file_mtime(path)
+        if mtime is None:
+            return None, {}
+        with open(path, 'r') as file:
+            return mtime, json.load(file)
+
+    def read_all(self, config_type):
+        for guild_id in self.guild_ids():
+            try:
+                version, config = self.read(guild_id, config_type)
+            except (OSError, ValueError) as e:
+                logger.error(f"Error loading {config_type} config for guild {guild_id}: {e}")
+                continue
+            if version is not None:
+                yield guild_id, version, config
+
+    def write(self, guild_id, config_type, config):
+        return self.write_many(guild_id, {config_type: config})[config_type]
+
+    def write_many(self, guild_id, configs):
+        """Write several of a guild's configs, returning their new versions.
+
+        Every config goes to a temp file first and they are only renamed over
+        the old ones once all of them are on disk, so a failed write leaves
+        every config as it was and a crash never leaves a truncated one.
+        """
+        directory = os.path.join(CONFIG_DIR, str(guild_id))
+        os.makedirs(directory, exist_ok=True)
+        written = []
+        try:
+            for config_type, config in configs.items():
+                path = config_path(guild_id, config_type)
+                # A fresh temp file per write, so writes of the same config from
+                # other threads or cluster workers never share one
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'{config_type}.json.', suffix='.tmp')
+                written.append((tmp_path, path))
+                with os.fdopen(fd, 'w') as file:
+                    # mkstemp makes the file private; keep configs readable like before
+                    os.chmod(tmp_path, 0o644)
+                    json.dump(config, file, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+        except Exception:
+            for tmp_path, _ in written:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            raise
+        for tmp_path, path in written:
+            os.replace(tmp_path, path)
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            dir_fd = None
+        if dir_fd is not None:
+            try:
+                os.fsync(dir_fd)
+            except OSError:
+                pass
+            finally:
+                os.close(dir_fd)
+        return {config_type: _file_mtime(config_path(guild_id, config_type)) for config_type in configs}
+
+    def versions(self, config_type):
+        for guild_id in self.guild_ids():
+            version = _file_mtime(config_path(guild_id, config_type))
+            if version is not None:
+                yield guild_id, version
+
+    def guild_ids(self):
+        if not os.path.isdir(CONFIG_DIR):
+            return
+        for entry in os.scandir(CONFIG_DIR):
+            if entry.is_dir() and entry.name.isdigit():
+                yield int(entry.name)
+
+
+class SqliteConfigBackend:
+    """All guild configs in one SQLite database running in WAL mode.
+
+    Every row carries a version that is bumped on each write, which the cache
+    uses the same way it uses file mtimes for the JSON backend. Writes share
+    one connection under a lock; each thread reads through a connection of
+    its own, so reads on the event loop never wait for a commit.
+    """
+
+    name = 'sqlite'
+
+    # Statements are kept as constants so sqlite3's statement cache reuses
+    # the prepared form on every call
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS configs ("
+        " guild_id INTEGER NOT NULL,"
+        " config_type TEXT NOT NULL,"
+        " data TEXT NOT NULL,"
+        " version INTEGER NOT NULL DEFAULT 1,"
+        " PRIMARY KEY (guild_id, config_type)"
+        ") WITHOUT ROWID"
+    )
+    _SELECT_VERSION = "SELECT version FROM configs WHERE guild_id = ? AND config_type = ?"
+    _SELECT = "SELECT version, data FROM configs WHERE guild_id = ? AND config_type = ?"
+    _SELECT_ALL = "SELECT guild_id, version, data FROM configs WHERE config_type = ?"
+    _SELECT_VERSIONS = "SELECT guild_id, version FROM configs WHERE config_type = ?"
+    _SELECT_GUILDS = "SELECT DISTINCT guild_id FROM configs"
+    _UPSERT = (
+        "INSERT INTO configs (guild_id, config_type, data) VALUES (?, ?, ?) "
+        "ON CONFLICT (guild_id, config_type) DO UPDATE "
+        "SET data = excluded.data, version = configs.version + 1 "
+        "RETURNING version"
+    )
+    _INSERT_IGNORE = "INSERT OR IGNORE INTO configs (guild_id, config_type, data) VALUES (?, ?, ?)"
+
+    def __init__(self, path=CONFIG_DB_PATH):
+        self.path = path
+        self._conn = None
+        # Serializes writes on the shared connection; reads don't take it
+        self._lock = threading.Lock()
+        # Each thread's own read connection
+        self._local = threading.local()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(self._SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._lock:
+                # Creates the database and its schema on first use
+                self._connect()
+            conn = self._local.conn = sqlite3.connect(self.path, isolation_level=None)
+        return conn
+
+    def version(self, guild_id, config_type):
+        row = self._reader().execute(self._SELECT_VERSION, (int(guild_id), config_type)).fetchone()
+        return row[0] if row else None
+
+    def read(self, guild_id, config_type):
+        row = self._reader().execute(self._SELECT, (int(guild_id), config_type)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def read_all(self, config_type):
+        rows = self._reader().execute(self._SELECT_ALL, (config_type,)).fetchall()
+        for guild_id, version, data in rows:
+            yield guild_id, version, json.loads(data)
+
+    def versions(self, config_type):
+        return self._reader().execute(self._SELECT_VERSIONS, (config_type,)).fetchall()
+
+    def write(self, guild_id, config_type, config):
+        data = json.dumps(config)
+        with self._lock:
+            return self._connect().execute(self._UPSERT, (int(guild_id), config_type, data)).fetchone()[0]
+
+    def write_many(self, guild_id, configs):
+        """Write several of a guild's configs in one transaction, returning their new versions."""
+        rows = [(int(guild_id), config_type, json.dumps(config)) for config_type, config in configs.items()]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                versions = {row[1]: conn.execute(self._UPSERT, row).fetchone()[0] for row in rows}
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return versions
+
+    def guild_ids(self):
+        rows = self._reader().execute(self._SELECT_GUILDS).fetchall()
+        return [row[0] for row in rows]
+
+    def import_json_tree(self, source=None):
+        """Copy every config from the JSON tree into the database.
+
+        Rows that already exist are left alone, so running it twice is harmless.
+        Returns the number of configs imported.
+        """
+        source = source or JsonConfigBackend()
+        rows = [
+            (guild_id, config_type, json.dumps(config))
+            for config_type in CONFIG_TYPES
+            for guild_id, _, config in source.read_all(config_type)
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                before = conn.total_changes
+                conn.executemany(self._INSERT_IGNORE, rows)
+                imported = conn.total_changes - before
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return imported
+
+    def is_empty(self):
+        return self._reader().execute("SELECT 1 FROM configs LIMIT 1").fetchone() is None
+
+
+def open_backend(name=CONFIG_BACKEND):
+    if name == 'json':
+        return JsonConfigBackend()
+    if name == 'sqlite':
+        return SqliteConfigBackend()
+    raise ValueError(f"Unknown CONFIG_BACKEND {name!r} (expected 'json' or 'sqlite')")
+
+
+config_backend = open_backend()
+
+
+def prepare_backend():
+    logger.info(f"Using {config_backend.name} config backend")
+    # First start on SQLite: bring over whatever the JSON tree holds
+    if config_backend.name == 'sqlite' and config_backend.is_empty() and any(JsonConfigBackend().guild_ids()):
+        imported = config_backend.import_json_tree()
+        logger.info(f"Migrated {imported} configs from {CONFIG_DIR}/ into {config_backend.path}")
+
+
+class ConfigCache:
+    """Keeps each guild's format/error/logs configs in memory.
+
+    Entries are trusted for `ttl` seconds, after which a single version check
+    (an `os.stat` for JSON, a primary-key lookup for SQLite) decides whether
+    the config changed and has to be read again.
+    """
+
+    def __init__(self, ttl=CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, guild_id, config_type):
+        key = (int(guild_id), config_type)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[2] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if entry[0] is _PENDING:
+                self.hits += 1
+                return entry[1]
+            self.revalidations += 1
+            if config_backend.version(guild_id, config_type) == entry[0]:
+                entry[2] = now
+                self.hits += 1
+                return entry[1]
+
+        self.misses += 1
+        version, config = config_backend.read(guild_id, config_type)
+        self._entries[key] = [version, config, now]
+        if config_type == 'format':
+            # A hand edit may have moved the appeal channel
+            appeal_channels.reloaded(guild_id, version, config)
+        return config
+
+    def put(self, guild_id, config_type, config, version):
+        self._entries[(int(guild_id), config_type)] = [version, config, time.monotonic()]
+
+    def put_if_newer(self, guild_id, config_type, config, version):
+        """Cache a config read earlier, unless what's cached is the same age or newer.
+
+        Returns whether it was cached. An unsaved config is always newer.
+        """
+        entry = self._entries.get((int(guild_id), config_type))
+        if entry is not None and (entry[0] is _PENDING or (entry[0] is not None and entry[0] >= version)):
+            return False
+        self.put(guild_id, config_type, config, version)
+        return True
+
+    def invalidate(self, guild_id=None, config_type=None):
+        if guild_id is None:
+            self._entries.clear()
+            return
+        for key in list(self._entries):
+            if key[0] == int(guild_id) and config_type in (None, key[1]):
+                del self._entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+config_cache = ConfigCache()
+
+
+def load_config(guild_id, config_type):
+    # Callers are free to mutate what they get back, so hand out a copy
+    return copy.deepcopy(config_cache.get(guild_id, config_type))
+
+
+def peek_config(guild_id, config_type):
+    """Return the cached config itself, without copying.
+
+    Meant for hot read-only paths; the result must never be mutated. The
+    objects inside only change identity when the config is reloaded or saved,
+    which lets derived indexes detect changes with an `is` check.
+    """
+    return config_cache.get(guild_id, config_type)
+
+
+class ConfigWriter:
+    """Write-behind writer for config files.
+
+    Saves are queued per guild/config, coalesced for `delay` seconds and then
+    written in a worker thread so the event loop never waits on disk. A save
+    that fails stays queued and is retried, waiting twice as long each time up
+    to `retry_max` seconds; flush() gives it one last try.
+    """
+
+    def __init__(self, delay=CONFIG_WRITE_DELAY, retry_max=CONFIG_WRITE_RETRY_MAX):
+        self.delay = delay
+        self.retry_max = retry_max
+        self._flushing = False
+        # Set by flush() to cut short the waits between retries
+        self._wake = asyncio.Event()
+        self._pending = {}
+        self._tasks = {}
+        self._locks = {}
+        self.writes = 0
+        self.coalesced = 0
+        self.commits = 0
+        self.write_failed = 0
+
+    def schedule(self, guild_id, config_type, config):
+        key = (int(guild_id), config_type)
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = config
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.get_running_loop().create_task(self._run(key))
+
+    async def _run(self, key):
+        delay = self.delay
+        try:
+            while key in self._pending:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self._flushing:
+                    # Shutting down: flush() writes it straight away
+                    break
+                if await self._write(key):
+                    delay = self.delay
+                elif self._flushing:
+                    # Shutting down: flush() makes the last attempt
+                    break
+                else:
+                    delay = min(delay * 2, self.retry_max)
+        finally:
+            del self._tasks[key]
+
+    def _lock(self, key):
+        return self._locks.setdefault(key, asyncio.Lock())
+
+    async def _write(self, key):
+        # Only one write per config at a time, so an older write can never
+        # land on disk or in the cache after a newer one or a commit
+        async with self._lock(key):
+            # commit() may have taken over the queued save
+            config = self._pending.pop(key, None)
+            if config is None:
+                return True
+            guild_id, config_type = key
+            try:
+                version = await asyncio.to_thread(config_backend.write, guild_id, config_type, config)
+            except Exception as e:
+                logger.error(f"Error writing {config_type} config for guild {guild_id}: {e}")
+                self.write_failed += 1
+                # Keep it queued, unless a newer save has taken its place meanwhile
+                self._pending.setdefault(key, config)
+                return False
+            self.writes += 1
+            # A newer save may have been queued while this one was on disk
+            if key not in self._pending:
+                _stored(guild_id, config_type, config, version)
+            return True
+
+    def is_pending(self, guild_id, config_type):
+        return (int(guild_id), config_type) in self._pending
+
+    async def commit(self, guild_id, configs):
+        """Write several of a guild's configs right away, all or none of them.
+
+        Saves still queued for those configs are superseded and dropped. The
+        cache only switches over once everything is stored, so readers never
+        see part of a commit; errors are raised to the caller.
+        """
+        configs = {config_type: copy.deepcopy(config) for config_type, config in configs.items()}
+        keys = sorted((int(guild_id), config_type) for config_type in configs)
+        async with contextlib.AsyncExitStack() as stack:
+            # Wait for writes of these configs already on their way to disk
+            for key in keys:
+                await stack.enter_async_context(self._lock(key))
+            superseded = {key[1]: self._pending.pop(key) for key in keys if key in self._pending}
+            try:
+                versions = await asyncio.to_thread(config_backend.write_many, guild_id, configs)
+            except Exception:
+                # Nothing was written, so the older saves still have to happen
+                for config_type, config in superseded.items():
+                    if not self.is_pending(guild_id, config_type):
+                        self.schedule(guild_id, config_type, config)
+                raise
+            self.commits += 1
+            for config_type, config in configs.items():
+                # Saves made during the commit are newer and stay in the cache
+                if not self.is_pending(guild_id, config_type):
+                    _stored(guild_id, config_type, config, versions[config_type])
+        return configs
+
+    async def flush(self):
+        self._flushing = True
+        # Don't sit out a retry backoff; whatever is queued is written below
+        self._wake.set()
+        try:
+            while self._tasks:
+                await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            # Queued and still failing saves get one last try
+            for key in list(self._pending):
+                await self._write(key)
+        finally:
+            self._flushing = False
+            self._wake.clear()
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "commits": self.commits,
+            "write_failed": self.write_failed,
+        }
+
+
+config_writer = ConfigWriter()
+
+
+def _stored(guild_id, config_type, config, version):
+    config_cache.put(guild_id, config_type, config, version)
+    if config_type == 'format':
+        # Our own write, so the index has no reason to read it back
+        appeal_channels.reloaded(guild_id, version, config)
+
+
+def save_config(guild_id, config_type, config):
+    config = copy.deepcopy(config)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop (startup, scripts): write straight through
+        version = config_backend.write(guild_id, config_type, config)
+        _stored(guild_id, config_type, config, version)
+        return
+    # Readers see the new config right away; the file follows shortly
+    config_cache.put(guild_id, config_type, config, _PENDING)
+    config_writer.schedule(guild_id, config_type, config)
+
+
+# Per-channel settings in format.json's `appeal_channels` that take the place
+# of the guild-wide ones for that channel
+CHANNEL_OVERRIDE_KEYS = (
+    'message_format', 'format_ignore_case', 'format_tolerant_whitespace', 'whitelisted_roles',
+    'error_message', 'steam_id_error_message', 'duplicate_error_message',
+    'duplicate_steam_id_action', 'duplicate_window_days',
+)
+
+# Used when a guild turns on duplicate detection without choosing a window,
+# or chooses one that isn't a positive number of days
+DEFAULT_DUPLICATE_WINDOW_DAYS = 30
+
+
+def duplicate_window_days(value):
+    """`duplicate_window_days` from a config as a number, or None if it isn't one."""
+    if isinstance(value, bool):
+        return None
+    try:
+        days = float(value)
+    except (TypeError, ValueError):
+        return None
+    return days if 0 < days < math.inf else None
+
+
+def appeal_channel_ids(format_config):
+    """Every appeal channel in a format config.
+
+    `ban_appeal_channel_id` is the channel set up by the wizard and uses the
+    guild-wide settings; `appeal_channels` maps further channel IDs to their
+    overrides. Configs from before multiple channels simply have no
+    `appeal_channels` and keep working as they are.
+    """
+    channel_ids = []
+    for channel_id in format_config.get('appeal_channels') or {}:
+        try:
+            channel_ids.append(int(channel_id))
+        except ValueError:
+            # A hand edit gone wrong shouldn't take the guild's other channels with it
+            logger.warning(f"Ignoring appeal channel {channel_id!r}: not a channel ID")
+    primary = format_config.get('ban_appeal_channel_id')
+    if primary and int(primary) not in channel_ids:
+        channel_ids.insert(0, int(primary))
+    return channel_ids
+
+
+class ChannelSettingsCache:
+    """Each appeal channel's view of its guild's format config.
+
+    That's the guild-wide config with the channel's overrides on top, or the
+    config itself when there are none. The merged dict is rebuilt only when
+    the format config object is replaced, so its values keep their identity
+    for the validator and whitelist caches. An invalid `duplicate_window_days`
+    is replaced with the default here, once per reload. Like `peek_config`,
+    the result must never be mutated.
+    """
+
+    def __init__(self):
+        self._settings = {}
+
+    def get(self, channel_id, format_config):
+        entry = self._settings.get(channel_id)
+        if entry is not None and entry[0] is format_config:
+            return entry[1]
+        overrides = (format_config.get('appeal_channels') or {}).get(str(channel_id))
+        if overrides:
+            settings = dict(format_config)
+            settings.update((key, overrides[key]) for key in CHANNEL_OVERRIDE_KEYS if key in overrides)
+        else:
+            settings = format_config
+        window = settings.get('duplicate_window_days', DEFAULT_DUPLICATE_WINDOW_DAYS)
+        if duplicate_window_days(window) is None:
+            logger.warning(f"Invalid duplicate_window_days {window!r} for channel {channel_id}, "
+                           f"using {DEFAULT_DUPLICATE_WINDOW_DAYS}")
+            settings = dict(settings)
+            settings['duplicate_window_days'] = DEFAULT_DUPLICATE_WINDOW_DAYS
+        self._settings[channel_id] = (format_config, settings)
+        return settings
+
+    def discard(self, channel_id):
+        self._settings.pop(channel_id, None)
+
+
+channel_settings = ChannelSettingsCache()
+
+
+class AppealChannelIndex:
+    """Maps ban appeal channel IDs to the guild they belong to.
+
+    `on_message` checks this before anything else, so messages outside an
+    appeal channel are rejected with a single dict lookup however many
+    channels a guild has. `refresh()` picks up channels changed outside this
+    process by comparing config versions.
+    """
+
+    def __init__(self):
+        self._channels = {}
+        self._by_guild = {}
+        # guild_id -> version of the format config the entry came from
+        self._versions = {}
+
+    def __contains__(self, channel_id):
+        return channel_id in self._channels
+
+    def __len__(self):
+        return len(self._channels)
+
+    def get(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def items(self):
+        return list(self._channels.items())
+
+    def update(self, guild_id, format_config):
+        """Point the index at the appeal channels in a guild's format config."""
+        guild_id = int(guild_id)
+        old_channel_ids = self._by_guild.pop(guild_id, ())
+        for channel_id in old_channel_ids:
+            self._channels.pop(channel_id, None)
+        channel_ids = appeal_channel_ids(format_config)
+        for channel_id in channel_ids:
+            self._channels[channel_id] = guild_id
+        if channel_ids:
+            self._by_guild[guild_id] = channel_ids
+        # Forget what was derived for channels that are no longer appeal channels
+        for channel_id in set(old_channel_ids).difference(channel_ids):
+            channel_settings.discard(channel_id)
+            format_validators.discard(channel_id)
+            role_whitelists.discard(channel_id)
+
+    def reloaded(self, guild_id, version, format_config):
+        """Follow a format config the cache has just read from disk."""
+        guild_id = int(guild_id)
+        if self._versions.get(guild_id) == version:
+            return
+        self._versions[guild_id] = version
+        self.update(guild_id, format_config)
+
+    def rebuild(self):
+        self._channels.clear()
+        self._by_guild.clear()
+        self._versions.clear()
+        # One batch read of every format config, which also warms the cache
+        for guild_id, version, config in config_backend.read_all('format'):
+            config_cache.put(guild_id, 'format', config, version)
+            self.update(guild_id, config)
+            self._versions[guild_id] = version
+        logger.info(f"Indexed {len(self._channels)} ban appeal channels")
+
+    @staticmethod
+    def _read_changed(known_versions):
+        # Runs in a worker thread: a version listing, then reads of only the
+        # configs that changed
+        changed = []
+        for guild_id, version in config_backend.versions('format'):
+            if known_versions.get(guild_id) != version:
+                version, config = config_backend.read(guild_id, 'format')
+                if version is not None:
+                    changed.append((guild_id, version, config))
+        return changed
+
+    async def refresh(self):
+        changed = await asyncio.to_thread(self._read_changed, dict(self._versions))
+        for guild_id, version, config in changed:
+            # A save of our own that is still queued, or that landed while
+            # the thread was reading, is newer than what was read
+            if not config_cache.put_if_newer(guild_id, 'format', config, version):
+                continue
+            self._versions[guild_id] = version
+            self.update(guild_id, config)
+        return len(changed)
+
+    async def refresh_periodically(self, interval=APPEAL_INDEX_REFRESH):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing ban appeal channels: {e}")
+
+
+appeal_channels = AppealChannelIndex()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ban appeal bot config store tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate = subparsers.add_parser('migrate', help="Import the config/<guild_id>/*.json tree into SQLite")
+    migrate.add_argument('--db', default=CONFIG_DB_PATH, help="Database file (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command == 'migrate':
+        imported = SqliteConfigBackend(args.db).import_json_tree()
+        logger.info(f"Imported {imported} configs into {args.db}")
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import asyncio
+import inspect
+import logging
+import threading
+import traceback
+import collections
+from config_store import CONFIG_DIR
+
+logger = logging.getLogger('discord')
+
+# Opt-in diagnostics mode: stall detection, asyncio debug and the /profile command
+DIAGNOSTICS = os.getenv('DIAGNOSTICS', '').lower() in ('1', 'true', 'yes', 'on')
+# Anything holding the event loop longer than this (in ms) gets reported
+SLOW_CALLBACK_MS = float(os.getenv('SLOW_CALLBACK_MS', '100'))
+# Interval between profiler samples, in ms
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = os.path.join(CONFIG_DIR, 'profiles')
+
+
+def _describe_frame(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _innermost_coroutine(frame):
+    # Walk outwards from the running frame to the first coroutine, which is
+    # the task that is holding the loop
+    while frame is not None:
+        if frame.f_code.co_flags & inspect.CO_COROUTINE:
+            return frame
+        frame = frame.f_back
+    return None
+
+
+class LoopStallDetector:
+    """Watches the event loop from a separate thread and reports stalls.
+
+    A task on the loop stamps a heartbeat; when the heartbeat is older than
+    the threshold, the watcher captures the loop thread's stack and logs which
+    coroutine was running and where it was blocked.
+    """
+
+    def __init__(self, threshold=SLOW_CALLBACK_MS / 1000):
+        self.threshold = threshold
+        self.stalls = 0
+        self.longest = 0.0
+        self._last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._task = None
+
+    def start(self, loop):
+        self._loop_thread_id = threading.get_ident()
+        self._task = loop.create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name='loop-stall-detector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _tick(self):
+        interval = self.threshold / 4
+        while True:
+            self._last_tick = time.monotonic()
+            await asyncio.sleep(interval)
+
+    def _watch(self):
+        reported_tick = None
+        while not self._stop.wait(self.threshold / 4):
+            last_tick = self._last_tick
+            blocked = time.monotonic() - last_tick
+            if blocked < self.threshold + self.threshold / 4 or last_tick == reported_tick:
+                continue
+            # Report each stall once, while it's still happening
+            reported_tick = last_tick
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self.stalls += 1
+            self.longest = max(self.longest, blocked)
+            coroutine = _innermost_coroutine(frame)
+            owner = _describe_frame(coroutine) if coroutine is not None else "a plain callback"
+            stack = ''.join(traceback.format_stack(frame, limit=15))
+            logger.warning(f"Event loop blocked for at least {blocked * 1000:.0f}ms in {owner}, "
+                           f"at {_describe_frame(frame)}:\n{stack}")
+
+    def stats(self):
+        return {"stalls": self.stalls, "longest_seconds": self.longest}
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from a background thread.
+
+    Samples are aggregated as folded stacks (`frame;frame;frame count`), the
+    format flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._samples = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._target_thread_id = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return False
+        self._samples = collections.Counter()
+        self._target_thread_id = threading.get_ident()
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and return the collected folded stacks."""
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        samples, self._samples = self._samples, None
+        return samples
+
+    def write(self, samples, directory=PROFILE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}.folded")
+        with open(path, 'w') as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+        return path
+
+
+stall_detector = LoopStallDetector()
+profiler = SamplingProfiler()
+
+
+def enable(loop):
+    """Turn on diagnostics for the running loop when DIAGNOSTICS is set."""
+    if not DIAGNOSTICS:
+        return False
+    # asyncio's own debug mode names the slow callback or task as well
+    loop.set_debug(True)
+    loop.slow_callback_duration = SLOW_CALLBACK_MS / 1000
+    logging.getLogger('asyncio').setLevel(logging.WARNING)
+    stall_detector.start(loop)
+    logger.info(f"Diagnostics enabled: reporting event loop stalls over {SLOW_CALLBACK_MS:.0f}ms")
+    return True
@@ -0,0 +1,511 @@
+import io
+import os
+import time
+import asyncio
+import logging
+import datetime
+import discord
+from metrics import metrics
+from audit_log import audit_log
+
+logger = logging.getLogger('discord')
+
+# Upper bound for each Discord call made while enforcing an appeal
+ENFORCEMENT_TIMEOUT = float(os.getenv('ENFORCEMENT_TIMEOUT', '10'))
+
+# How long a user whose DMs are closed is skipped before we try again
+DM_BLOCKED_TTL = float(os.getenv('DM_BLOCKED_TTL', '21600'))
+# Seconds a user isn't sent the same DM again, e.g. for reposting one bad appeal
+DM_REPEAT_WINDOW = float(os.getenv('DM_REPEAT_WINDOW', '600'))
+
+# Deletion log batching: post after this many entries or this many seconds,
+# whichever comes first, and drop entries past the queue limit
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', '10'))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '5'))
+LOG_QUEUE_LIMIT = int(os.getenv('LOG_QUEUE_LIMIT', '500'))
+
+# Discord limits for a single message
+EMBEDS_PER_MESSAGE = 10
+EMBED_CHARS_PER_MESSAGE = 6000
+# Longer message content is cut short in the embed and attached as a file
+LOG_CONTENT_LIMIT = 1000
+
+# Flood limiting in appeal channels: each user may post FLOOD_BURST messages
+# at once, regaining one every FLOOD_REFILL_SECONDS; 0 turns it off
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '5'))
+FLOOD_REFILL_SECONDS = float(os.getenv('FLOOD_REFILL_SECONDS', '30'))
+# Messages over the limit are collected this long and removed together
+FLOOD_COLLECT_SECONDS = float(os.getenv('FLOOD_COLLECT_SECONDS', '3'))
+# How often users whose buckets have refilled are forgotten
+FLOOD_PRUNE_INTERVAL = 300
+
+# Bulk delete takes at most 100 messages, none older than 14 days
+BULK_DELETE_LIMIT = 100
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14, minutes=-5)
+
+
+def member_role_ids(member):
+    # Member._roles holds the role IDs straight from the gateway payload;
+    # Member.roles would look up and sort a Role object for each of them
+    return getattr(member, '_roles', ())
+
+
+class DMBlocklist:
+    """Users known to reject DMs, each remembered until a TTL runs out."""
+
+    def __init__(self, ttl=DM_BLOCKED_TTL):
+        self.ttl = ttl
+        self._expiry = {}
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def is_blocked(self, user_id):
+        expiry = self._expiry.get(user_id)
+        if expiry is None:
+            return False
+        if expiry <= time.monotonic():
+            del self._expiry[user_id]
+            return False
+        return True
+
+    def add(self, user_id):
+        self._expiry[user_id] = time.monotonic() + self.ttl
+        # Keep the table from growing forever on big servers
+        if len(self._expiry) > 10000:
+            self.prune()
+
+    def prune(self):
+        now = time.monotonic()
+        for user_id in [user_id for user_id, expiry in self._expiry.items() if expiry <= now]:
+            del self._expiry[user_id]
+
+
+class FloodLimiter:
+    """Token buckets per guild and user, one float each.
+
+    A bucket is kept in GCRA form: the time at which it will be full again.
+    Taking a token pushes that time out by `refill` seconds, and a user is
+    over the limit when it lies more than `burst` tokens' worth ahead. Users
+    whose buckets are full again carry no state and are pruned periodically.
+    """
+
+    def __init__(self, burst=FLOOD_BURST, refill=FLOOD_REFILL_SECONDS, prune_interval=FLOOD_PRUNE_INTERVAL):
+        self.enabled = burst > 0
+        self.refill = refill
+        # How far ahead the full time may run before a message is refused
+        self.tolerance = refill * (burst - 1)
+        self.prune_interval = prune_interval
+        self._full_at = {}
+        self._next_prune = time.monotonic() + prune_interval
+        self.limited = 0
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def hit(self, guild_id, user_id):
+        """Take a token for one message; True means the user is over the limit."""
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        key = (guild_id, user_id)
+        full_at = self._full_at.get(key, now)
+        if full_at < now:
+            full_at = now
+        if full_at - now > self.tolerance:
+            self.limited += 1
+            return True
+        self._full_at[key] = full_at + self.refill
+        if now >= self._next_prune:
+            self.prune(now)
+        return False
+
+    def prune(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._next_prune = now + self.prune_interval
+        for key in [key for key, full_at in self._full_at.items() if full_at <= now]:
+            del self._full_at[key]
+
+    def stats(self):
+        return {
+            "tracked_users": len(self._full_at),
+            "limited": self.limited,
+        }
+
+
+class _FloodBurst:
+    __slots__ = ('messages', 'log_channel', 'task')
+
+    def __init__(self, log_channel):
+        self.messages = []
+        self.log_channel = log_channel
+        self.task = None
+
+
+class _GuildLog:
+    __slots__ = ('channel', 'entries', 'full', 'task')
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.entries = []
+        self.full = asyncio.Event()
+        self.task = None
+
+
+class DeletionLogReporter:
+    """Queues deletion log entries per guild and posts them as batched embeds.
+
+    A guild's queue is flushed once it holds `batch_size` entries or
+    `interval` seconds after the first entry arrived. Each post packs as many
+    embeds as Discord allows into one message, so a burst of rejections costs
+    a handful of log channel calls instead of one per deletion.
+    """
+
+    def __init__(self, batch_size=LOG_BATCH_SIZE, interval=LOG_FLUSH_INTERVAL, queue_limit=LOG_QUEUE_LIMIT,
+                 timeout=ENFORCEMENT_TIMEOUT):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self._guilds = {}
+        self._closing = False
+        self.queued = 0
+        self.dropped = 0
+        self.posted = 0
+        self.messages_sent = 0
+        self.send_failed = 0
+
+    def report(self, guild_id, log_channel, message, reason, content=None, deleted=True):
+        state = self._guilds.get(guild_id)
+        if state is None:
+            state = self._guilds[guild_id] = _GuildLog(log_channel)
+        state.channel = log_channel
+        if len(state.entries) >= self.queue_limit:
+            self.dropped += 1
+            return
+        # Keep only what the embed needs, not the Message object
+        state.entries.append((
+            message.id,
+            message.author.mention,
+            reason,
+            (message.content if content is None else content).strip(),
+            message.created_at,
+            deleted,
+        ))
+        self.queued += 1
+        if state.task is None:
+            state.task = asyncio.get_running_loop().create_task(self._run(state))
+        elif len(state.entries) >= self.batch_size:
+            state.full.set()
+
+    async def _run(self, state):
+        try:
+            while state.entries:
+                if len(state.entries) < self.batch_size and not self._closing:
+                    try:
+                        await asyncio.wait_for(state.full.wait(), self.interval)
+                    except asyncio.TimeoutError:
+                        pass
+                state.full.clear()
+                batch = state.entries[:self.batch_size]
+                del state.entries[:self.batch_size]
+                await self._post(state.channel, batch)
+        finally:
+            state.task = None
+
+    async def _post(self, channel, batch):
+        embeds = []
+        files = []
+        size = 0
+        for message_id, mention, reason, content, created_at, deleted in batch:
+            embed, file = self._build_entry(message_id, mention, reason, content, created_at, deleted)
+            if embeds and (len(embeds) == EMBEDS_PER_MESSAGE or size + len(embed) > EMBED_CHARS_PER_MESSAGE):
+                await self._send(channel, embeds, files)
+                embeds, files, size = [], [], 0
+            embeds.append(embed)
+            size += len(embed)
+            if file is not None:
+                files.append(file)
+        if embeds:
+            await self._send(channel, embeds, files)
+
+    def _build_entry(self, message_id, mention, reason, content, created_at, deleted):
+        if deleted:
+            embed = discord.Embed(
+                description=f"Deleted message from {mention} for {reason}.",
+                color=discord.Color.red(),
+                timestamp=created_at
+            )
+        else:
+            # Moderators have to remove it themselves
+            embed = discord.Embed(
+                description=f"Could not delete message from {mention} for {reason}.",
+                color=discord.Color.orange(),
+                timestamp=created_at
+            )
+        file = None
+        if len(content) > LOG_CONTENT_LIMIT:
+            file = discord.File(io.BytesIO(content.encode('utf-8')), filename=f"deleted-{message_id}.txt")
+            content = content[:LOG_CONTENT_LIMIT - 30] + "\n… (truncated, full text attached)"
+        embed.add_field(name="Message content", value=content or "*(empty)*", inline=False)
+        return embed, file
+
+    async def _send(self, channel, embeds, files):
+        start = metrics.now()
+        try:
+            await asyncio.wait_for(channel.send(embeds=embeds, files=files), self.timeout)
+        except asyncio.TimeoutError as e:
+            self.send_failed += 1
+            logger.warning(f"Timed out posting deletion log to #{channel} after {self.timeout}s")
+            if metrics.enabled:
+                metrics.api_calls.inc('log', type(e).__name__)
+            return
+        except discord.HTTPException as e:
+            self.send_failed += 1
+            logger.warning(f"Failed to post deletion log to #{channel}: {e}")
+            if metrics.enabled:
+                metrics.api_calls.inc('log', type(e).__name__)
+            return
+        if metrics.enabled:
+            metrics.stage('log', start)
+            metrics.api_calls.inc('log', 'ok')
+        self.messages_sent += 1
+        self.posted += len(embeds)
+
+    async def flush(self):
+        """Post everything still queued without waiting for the interval."""
+        self._closing = True
+        try:
+            for state in self._guilds.values():
+                state.full.set()
+            tasks = [state.task for state in self._guilds.values() if state.task is not None]
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._closing = False
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "pending": sum(len(state.entries) for state in self._guilds.values()),
+            "dropped": self.dropped,
+            "posted": self.posted,
+            "messages_sent": self.messages_sent,
+            "send_failed": self.send_failed,
+        }
+
+
+class EnforcementPipeline:
+    """Deletes a rejected appeal, then logs it and DMs the author.
+
+    The delete goes first so the appeal disappears as soon as possible. The
+    log entry is handed to the batched reporter and the DM is sent right
+    away. Each call has its own timeout and a failure in one never stops the
+    others, except that an author whose appeal couldn't be deleted isn't told
+    it was removed; the log entry says the delete failed instead. Users over the flood limit skip all that: their messages are
+    collected for a few seconds and removed with one bulk delete, one log
+    entry and at most one DM.
+    """
+
+    def __init__(self, timeout=ENFORCEMENT_TIMEOUT, dm_blocklist=None, log_reporter=None, flood_limiter=None):
+        self.timeout = timeout
+        self.dm_blocklist = dm_blocklist if dm_blocklist is not None else DMBlocklist()
+        self.log_reporter = log_reporter if log_reporter is not None else DeletionLogReporter()
+        self.flood_limiter = flood_limiter if flood_limiter is not None else FloodLimiter()
+        # Users told about a flood, not DMed again until their bucket could have refilled
+        self.flood_notified = DMBlocklist(ttl=max(FLOOD_BURST, 1) * FLOOD_REFILL_SECONDS)
+        # (user, DM text) for DMs delivered within DM_REPEAT_WINDOW
+        self.recent_dms = DMBlocklist(ttl=DM_REPEAT_WINDOW)
+        self._bursts = {}
+        self.deleted = 0
+        self.delete_failed = 0
+        self.dms_sent = 0
+        self.dms_failed = 0
+        self.dms_skipped = 0
+        self.dms_repeated = 0
+        self.flagged = 0
+        self.floods = 0
+
+    async def _call(self, stage, action, coro):
+        start = metrics.now()
+        try:
+            await asyncio.wait_for(coro, self.timeout)
+            error = None
+        except asyncio.TimeoutError as e:
+            logger.warning(f"Timed out trying to {action} after {self.timeout}s")
+            error = e
+        except discord.HTTPException as e:
+            logger.warning(f"Failed to {action}: {e}")
+            error = e
+        if metrics.enabled:
+            metrics.stage(stage, start)
+            metrics.api_calls.inc(stage, 'ok' if error is None else type(error).__name__)
+        return error
+
+    def _audit(self, message, deleted, reason, rule, field, bulk=False):
+        if audit_log.enabled:
+            # How long the appeal stayed up before it was removed
+            latency = (discord.utils.utcnow() - message.created_at).total_seconds()
+            audit_log.record('delete', message, rule=rule, field=field, reason=reason, deleted=deleted,
+                             bulk=bulk, latency_ms=round(latency * 1000))
+
+    async def enforce(self, message, reason, log_channel=None, dm_text=None, rule=None, field=None):
+        error = await self._call('delete', 'delete message', message.delete())
+        # NotFound means someone else already removed it
+        deleted = error is None or isinstance(error, discord.NotFound)
+        if deleted:
+            self.deleted += 1
+        else:
+            self.delete_failed += 1
+        self._audit(message, deleted, reason, rule, field)
+
+        if log_channel is not None:
+            self.log_reporter.report(message.guild.id, log_channel, message, reason, deleted=deleted)
+        if deleted and dm_text and not self._skip_dm(message.author.id, dm_text):
+            await self._dm(message.author, dm_text)
+
+    async def enforce_bulk(self, channel, rejections, log_channel=None):
+        """Enforce many rejected appeals from one channel at once.
+
+        `rejections` holds (message, reason, dm_text, rule, field) tuples.
+        Messages young enough for bulk delete go out 100 per call; older ones
+        are deleted one by one. Each author gets at most one DM per call, and
+        only for a message that was actually deleted.
+        """
+        deleted = await self._delete_all(channel, rejections)
+
+        dms = {}
+        for message, reason, dm_text, _, _ in rejections:
+            if log_channel is not None:
+                self.log_reporter.report(message.guild.id, log_channel, message, reason,
+                                         deleted=message.id in deleted)
+            if message.id not in deleted:
+                continue
+            if dm_text and message.author.id not in dms and not self._skip_dm(message.author.id, dm_text):
+                dms[message.author.id] = self._dm(message.author, dm_text)
+        if dms:
+            await asyncio.gather(*dms.values())
+
+    async def _delete_all(self, channel, rejections):
+        """Delete the rejected messages, returning the IDs of those that are gone."""
+        removed = set()
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        recent = [rejection for rejection in rejections if rejection[0].created_at > cutoff]
+        old = [rejection for rejection in rejections if rejection[0].created_at <= cutoff]
+
+        for start in range(0, len(recent), BULK_DELETE_LIMIT):
+            chunk = recent[start:start + BULK_DELETE_LIMIT]
+            messages = [message for message, *_ in chunk]
+            error = await self._call('bulk_delete', f'bulk delete {len(chunk)} messages', channel.delete_messages(messages))
+            deleted = error is None or isinstance(error, discord.NotFound)
+            if deleted:
+                self.deleted += len(chunk)
+            else:
+                self.delete_failed += len(chunk)
+            for message, reason, _, rule, field in chunk:
+                self._audit(message, deleted, reason, rule, field, bulk=True)
+                if deleted:
+                    removed.add(message.id)
+        for message, reason, _, rule, field in old:
+            error = await self._call('delete', 'delete message', message.delete())
+            deleted = error is None or isinstance(error, discord.NotFound)
+            if deleted:
+                self.deleted += 1
+            else:
+                self.delete_failed += 1
+            self._audit(message, deleted, reason, rule, field)
+            if deleted:
+                removed.add(message.id)
+        return removed
+
+    def collect_flood(self, message, log_channel=None):
+        """Queue a message from a user over the flood limit for removal with the rest of their burst."""
+        key = (message.guild.id, message.channel.id, message.author.id)
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = self._bursts[key] = _FloodBurst(log_channel)
+            burst.task = asyncio.get_running_loop().create_task(self._flush_flood(key, burst))
+        burst.messages.append(message)
+
+    async def _flush_flood(self, key, burst):
+        try:
+            await asyncio.sleep(FLOOD_COLLECT_SECONDS)
+        finally:
+            del self._bursts[key]
+        await self.enforce_flood(burst.messages, burst.log_channel)
+
+    async def flush_floods(self):
+        """Remove every burst still being collected without waiting out the window."""
+        bursts = list(self._bursts.values())
+        for burst in bursts:
+            burst.task.cancel()
+        for burst in bursts:
+            await self.enforce_flood(burst.messages, burst.log_channel)
+
+    async def enforce_flood(self, messages, log_channel=None):
+        """Remove one user's burst of messages from a channel with a single log entry and DM."""
+        first = messages[0]
+        self.floods += 1
+        reason = f"flooding the appeal channel ({len(messages)} messages)"
+        removed = await self._delete_all(first.channel, [(message, reason, None, 'flood', None) for message in messages])
+
+        if log_channel is not None:
+            content = '\n\n'.join(message.content.strip() for message in messages)
+            self.log_reporter.report(first.guild.id, log_channel, first, reason, content=content,
+                                     deleted=bool(removed))
+        if not removed:
+            return
+        key = (first.guild.id, first.author.id)
+        if self.flood_notified.is_blocked(key) or self.dm_blocklist.is_blocked(first.author.id):
+            self.dms_skipped += 1
+            return
+        self.flood_notified.add(key)
+        await self._dm(first.author, (
+            f"Hi {first.author.mention}, you posted too many messages in the ban appeal channel, so "
+            f"{len(removed)} of them were removed. Please post a single appeal and wait for it to be reviewed."
+        ))
+
+    async def flag(self, message, emoji, reason=None, rule=None):
+        """React to an appeal moderators should look at, without removing it."""
+        error = await self._call('flag', 'flag message', message.add_reaction(emoji))
+        if error is None:
+            self.flagged += 1
+        audit_log.record('flag', message, rule=rule, reason=reason, flagged=error is None)
+
+    def _skip_dm(self, user_id, dm_text):
+        """Whether to hold back a DM: the user's DMs are closed or they just got the same one."""
+        if self.dm_blocklist.is_blocked(user_id):
+            self.dms_skipped += 1
+            return True
+        # The text itself, so two different DMs can never be taken for one
+        if self.recent_dms.is_blocked((user_id, dm_text)):
+            self.dms_repeated += 1
+            return True
+        return False
+
+    async def _dm(self, user, dm_text):
+        error = await self._call('dm', f'DM {user}', user.send(dm_text))
+        if error is None:
+            self.dms_sent += 1
+            # Only a DM that got through holds back the same one; a lost one may be sent again
+            self.recent_dms.add((user.id, dm_text))
+            return
+        self.dms_failed += 1
+        if isinstance(error, discord.Forbidden):
+            self.dm_blocklist.add(user.id)
+
+    def stats(self):
+        return {
+            "deleted": self.deleted,
+            "delete_failed": self.delete_failed,
+            "dms_sent": self.dms_sent,
+            "dms_failed": self.dms_failed,
+            "dms_skipped": self.dms_skipped,
+            "dms_repeated": self.dms_repeated,
+            "flagged": self.flagged,
+            "floods": self.floods,
+            "dm_blocked_users": len(self.dm_blocklist),
+        }
+
+
+enforcement = EnforcementPipeline()
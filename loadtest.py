@@ -0,0 +1,500 @@
+"""End-to-end load test for CustomBot against an in-process Discord stand-in.
+
+A local aiohttp app plays the Discord REST API (including per-route and
+global rate limits) and synthetic MESSAGE_CREATE payloads are fed straight
+into the bot's gateway event parser, so the whole path from event dispatch
+through config reads, validation and enforcement runs without any network
+access or real token:
+
+    python loadtest.py --guilds 200 --rate 2000 --duration 30 --output load.json
+
+`--members` gives every guild that many members, delivered the way startup
+chunking would, so RSS and time-to-ready can be compared with and without
+`--low-memory`.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+import collections
+import datetime
+import resource
+from aiohttp import web
+import discord
+
+API_PREFIX = '/api/v10'
+BOT_USER_ID = 900000000000000001
+APPLICATION_ID = 900000000000000002
+
+MEMBERS_PER_CHUNK = 1000
+
+# Fixed-window limits loosely modelled on Discord's: (requests, seconds) per
+# route and major parameter
+ROUTE_LIMITS = {
+    'POST /channels/{channel_id}/messages': (5, 5.0),
+    'DELETE /channels/{channel_id}/messages/{message_id}': (5, 1.0),
+    'POST /channels/{channel_id}/messages/bulk-delete': (1, 1.0),
+    'POST /users/@me/channels': (10, 10.0),
+}
+
+VALID_APPEAL = "AC Driver Name: {name}\nSteam ID: 7656119{digits}\nDetails: {details}"
+INVALID_APPEALS = [
+    "let me back in please",
+    "AC Driver Name: {name}\nDetails: {details}",
+    "AC Driver Name: {name}\nSteam ID: STEAM_0:1:{digits}\nDetails: {details}",
+]
+
+
+def snowflake_factory(start):
+    counter = itertools.count()
+
+    def next_id():
+        # Real snowflakes start with a millisecond timestamp
+        return (int(time.time() * 1000) - 1420070400000 << 22) + (start + next(counter)) % (1 << 22)
+
+    return next_id
+
+
+def json_response(data, status=200, headers=None):
+    # discord.py only decodes bodies whose Content-Type is exactly application/json
+    return web.Response(body=json.dumps(data).encode('utf-8'), status=status,
+                        headers=dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+
+def user_payload(user_id, name):
+    return {"id": str(user_id), "username": name, "discriminator": "0", "global_name": name, "avatar": None}
+
+
+class FakeDiscordAPI:
+    """The slice of Discord's REST API the bot uses, with rate limiting."""
+
+    def __init__(self, latency=0.0, rate_limits=True, global_limit=50):
+        self.latency = latency
+        self.rate_limits = rate_limits
+        self.global_limit = global_limit
+        self.calls = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self._windows = {}
+        self._global_window = [0.0, 0]
+        self._next_id = snowflake_factory(1 << 20)
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_get(API_PREFIX + '/users/@me', self.get_me)
+        self.app.router.add_get(API_PREFIX + '/oauth2/applications/@me', self.get_application)
+        self.app.router.add_put(API_PREFIX + '/applications/{application_id}/commands', self.put_commands)
+        self.app.router.add_post(API_PREFIX + '/channels/{channel_id}/messages', self.create_message)
+        self.app.router.add_delete(API_PREFIX + '/channels/{channel_id}/messages/{message_id}', self.no_content)
+        self.app.router.add_post(API_PREFIX + '/channels/{channel_id}/messages/bulk-delete', self.no_content)
+        self.app.router.add_post(API_PREFIX + '/users/@me/channels', self.create_dm)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        return self._runner.addresses[0][1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def _hit_window(self, key, limit, period, now):
+        window = self._windows.get(key)
+        if window is None or now >= window[0] + period:
+            window = self._windows[key] = [now, 0]
+        window[1] += 1
+        return window[1] <= limit, limit - window[1], window[0] + period - now
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        resource = request.match_info.route.resource
+        template = resource.canonical[len(API_PREFIX):] if resource is not None else request.path
+        route = f'{request.method} {template}'
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not self.rate_limits:
+            return await handler(request)
+
+        now = time.monotonic()
+        if now >= self._global_window[0] + 1:
+            self._global_window = [now, 0]
+        self._global_window[1] += 1
+        if self._global_window[1] > self.global_limit:
+            self.rate_limited['global'] += 1
+            retry_after = self._global_window[0] + 1 - now
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": retry_after, "global": True},
+                status=429, headers={'X-RateLimit-Global': 'true', 'X-RateLimit-Scope': 'global'}
+            )
+
+        limit, period = ROUTE_LIMITS.get(route, (50, 1.0))
+        key = (route, request.match_info.get('channel_id'))
+        allowed, remaining, reset_after = self._hit_window(key, limit, period, now)
+        headers = {
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(max(remaining, 0)),
+            'X-RateLimit-Reset-After': f'{reset_after:.3f}',
+            'X-RateLimit-Reset': f'{time.time() + reset_after:.3f}',
+            'X-RateLimit-Bucket': f'{abs(hash(route)):x}',
+        }
+        if not allowed:
+            self.rate_limited[route] += 1
+            return json_response(
+                {"message": "You are being rate limited.", "retry_after": reset_after, "global": False},
+                status=429, headers=dict(headers, **{'X-RateLimit-Scope': 'user'})
+            )
+        response = await handler(request)
+        response.headers.update(headers)
+        return response
+
+    async def get_me(self, request):
+        return json_response(dict(user_payload(BOT_USER_ID, 'loadtest-bot'), bot=True))
+
+    async def get_application(self, request):
+        return json_response({
+            "id": str(APPLICATION_ID), "name": "loadtest", "description": "", "icon": None,
+            "bot_public": False, "bot_require_code_grant": False, "verify_key": "",
+            "owner": user_payload(1, 'owner'), "flags": 0,
+        })
+
+    async def put_commands(self, request):
+        return json_response([])
+
+    async def create_message(self, request):
+        # Body may be JSON or multipart (log batches with attachments); it isn't needed
+        await request.read()
+        return json_response({
+            "id": str(self._next_id()), "channel_id": request.match_info['channel_id'],
+            "author": dict(user_payload(BOT_USER_ID, 'loadtest-bot'), bot=True),
+            "content": "", "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+            "mention_roles": [], "attachments": [], "embeds": [], "pinned": False, "type": 0,
+        })
+
+    async def create_dm(self, request):
+        data = await request.json()
+        return json_response({
+            "id": str(self._next_id()), "type": 1, "last_message_id": None,
+            "recipients": [user_payload(data['recipient_id'], 'appellant')],
+        })
+
+    async def no_content(self, request):
+        await request.read()
+        return web.Response(status=204)
+
+
+class SyntheticGuild:
+    def __init__(self, guild_id, next_id, rng):
+        self.id = guild_id
+        self.appeal_channel_id = next_id()
+        self.log_channel_id = next_id()
+        self.other_channel_ids = [next_id() for _ in range(5)]
+        self.roles = [next_id() for _ in range(20)]
+        self.whitelisted_role = self.roles[0]
+        self.users = [next_id() for _ in range(200)]
+        self.next_id = next_id
+        self.rng = rng
+
+    def payload(self):
+        channel_ids = [self.appeal_channel_id, self.log_channel_id] + self.other_channel_ids
+        return {
+            "id": str(self.id), "name": f"guild-{self.id}", "icon": None, "owner_id": "1",
+            "member_count": len(self.users), "large": True, "features": [], "emojis": [], "stickers": [],
+            "roles": [
+                {"id": str(role_id), "name": f"role-{n}", "permissions": "0", "position": n, "color": 0,
+                 "hoist": False, "managed": False, "mentionable": False}
+                for n, role_id in enumerate([self.id] + self.roles)
+            ],
+            "channels": [
+                {"id": str(channel_id), "type": 0, "name": f"channel-{n}", "position": n,
+                 "permission_overwrites": [], "guild_id": str(self.id)}
+                for n, channel_id in enumerate(channel_ids)
+            ],
+            "members": [], "presences": [], "voice_states": [], "threads": [],
+        }
+
+    def member_chunks(self, count):
+        # Large guilds send no member list with GUILD_CREATE; chunking fetches
+        # them in pieces of up to 1000
+        member_ids = self.users[:count] + [self.next_id() for _ in range(count - len(self.users))]
+        for start in range(0, len(member_ids), MEMBERS_PER_CHUNK):
+            yield [
+                {"user": user_payload(user_id, f"user{user_id % 1000}"),
+                 "roles": [str(role_id) for role_id in self.rng.sample(self.roles, 3)],
+                 "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0}
+                for user_id in member_ids[start:start + MEMBERS_PER_CHUNK]
+            ]
+
+    def configs(self):
+        return {
+            'format': {
+                "ban_appeal_channel_id": self.appeal_channel_id,
+                "whitelisted_roles": [self.whitelisted_role],
+                "message_format": "AC Driver Name:\nSteam ID:\nDetails:",
+            },
+            'error': {"error_message": "Use the format.", "steam_id_error_message": "Bad Steam ID."},
+            'logs': {"log_channel_id": self.log_channel_id},
+        }
+
+    def message(self, message_id, kind):
+        rng = self.rng
+        # Flood messages all come from the guild's first user
+        user_id = self.users[0] if kind == 'flood' else rng.choice(self.users)
+        roles = rng.sample(self.roles[1:], 3)
+        fields = {"name": f"driver{user_id % 1000}", "digits": f"{rng.randrange(8 * 10 ** 9, 10 ** 10):010d}", "details": "sorry"}
+        if kind == 'chatter':
+            channel_id = rng.choice(self.other_channel_ids)
+            content = "gg everyone"
+        else:
+            channel_id = self.appeal_channel_id
+            if kind == 'valid':
+                content = VALID_APPEAL.format(**fields)
+            else:
+                content = rng.choice(INVALID_APPEALS).format(**fields)
+            if kind == 'whitelisted':
+                roles.append(self.whitelisted_role)
+        return {
+            "id": str(message_id), "channel_id": str(channel_id), "guild_id": str(self.id),
+            "author": user_payload(user_id, f"user{user_id % 1000}"),
+            "member": {"roles": [str(role_id) for role_id in roles], "joined_at": "2024-01-01T00:00:00+00:00",
+                       "deaf": False, "mute": False, "flags": 0},
+            "content": content, "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+            "mention_roles": [], "attachments": [], "embeds": [], "pinned": False, "type": 0,
+        }
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # Peak rather than current RSS, in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def summarize(values, scale=1000.0):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1, int(fraction * (len(values) - 1)))] * scale, 3)
+
+    return {
+        "count": len(values),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(values[-1] * scale, 3),
+    }
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    next_id = snowflake_factory(0)
+
+    api = FakeDiscordAPI(latency=args.api_latency / 1000, rate_limits=not args.no_rate_limits,
+                         global_limit=args.global_limit)
+    port = await api.start()
+    discord.http.Route.BASE = f'http://127.0.0.1:{port}{API_PREFIX}'
+
+    # Imported late so the bot module picks up the temporary working directory
+    # and the memory settings
+    if args.low_memory:
+        os.environ['LOW_MEMORY'] = '1'
+    import bot as bot_module
+    from config_store import save_config, config_cache, config_writer
+    from enforcement import enforcement
+    from validation import verdict_cache
+
+    guilds = [SyntheticGuild(next_id(), next_id, rng) for _ in range(args.guilds)]
+    for guild in guilds:
+        for config_type, config in guild.configs().items():
+            save_config(guild.id, config_type, config)
+    await config_writer.flush()
+
+    client = bot_module.bot
+    await client.login('loadtest-token')
+    state = client._connection
+    rss_before = rss_mb()
+    # Only the bot's side counts towards time-to-ready, not building payloads
+    time_to_ready = 0.0
+    for guild in guilds:
+        payload = guild.payload()
+        ready_start = time.perf_counter()
+        state._add_guild_from_data(payload)
+        time_to_ready += time.perf_counter() - ready_start
+        if args.members and state._chunk_guilds:
+            # What the member chunks requested at startup end up doing, minus
+            # the gateway round trips
+            discord_guild = state._get_guild(guild.id)
+            for chunk in guild.member_chunks(args.members):
+                ready_start = time.perf_counter()
+                for data in chunk:
+                    member = discord.Member(guild=discord_guild, data=data, state=state)
+                    if state.member_cache_flags.joined:
+                        discord_guild._add_member(member)
+                time_to_ready += time.perf_counter() - ready_start
+    rss_ready = rss_mb()
+
+    injected_at = {}
+    latencies = []
+    in_flight = [0]
+    original_on_message = client.on_message
+
+    async def timed_on_message(message):
+        in_flight[0] += 1
+        try:
+            await original_on_message(message)
+        finally:
+            in_flight[0] -= 1
+            latencies.append(time.perf_counter() - injected_at.pop(message.id, time.perf_counter()))
+
+    client.on_message = timed_on_message
+
+    lags = []
+    running = True
+
+    async def measure_lag():
+        interval = 0.01
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(max(0.0, time.perf_counter() - start - interval))
+
+    lag_task = asyncio.create_task(measure_lag())
+
+    kinds = ['chatter', 'valid', 'invalid', 'whitelisted', 'flood']
+    weights = [args.chatter, args.valid, args.invalid, args.whitelisted, args.flood]
+    parse_message_create = state.parsers['MESSAGE_CREATE']
+    injected = collections.Counter()
+    start = time.perf_counter()
+    total_injected = 0
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= args.duration:
+            break
+        due = int(elapsed * args.rate) - total_injected
+        for _ in range(due):
+            kind = rng.choices(kinds, weights)[0]
+            message_id = next_id()
+            payload = rng.choice(guilds).message(message_id, kind)
+            injected_at[message_id] = time.perf_counter()
+            parse_message_create(payload)
+            injected[kind] += 1
+        total_injected += max(due, 0)
+        await asyncio.sleep(0.005)
+    injection_time = time.perf_counter() - start
+
+    # Let handlers still waiting on rate-limited calls finish
+    deadline = time.perf_counter() + args.drain_timeout
+    while in_flight[0] and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    unfinished = in_flight[0]
+    rss_end = rss_mb()
+    cached_members = sum(len(guild.members) for guild in client.guilds)
+    cached_messages = len(client.cached_messages)
+    running = False
+    await lag_task
+    await client.close()
+    await api.stop()
+
+    rest_calls = sum(api.calls.values())
+    startup_calls = sum(api.calls[route] for route in (
+        'GET /users/@me', 'GET /oauth2/applications/@me', 'PUT /applications/{application_id}/commands'
+    ))
+    return {
+        "settings": vars(args),
+        "memory": {
+            "low_memory": bot_module.LOW_MEMORY,
+            "time_to_ready_seconds": round(time_to_ready, 3),
+            "rss_mb_before_guilds": rss_before,
+            "rss_mb_ready": rss_ready,
+            "rss_mb_end": rss_end,
+            "cached_members": cached_members,
+            "cached_messages": cached_messages,
+        },
+        "events": {
+            "injected": total_injected,
+            "by_kind": dict(injected),
+            "injection_seconds": round(injection_time, 3),
+            "achieved_rate": round(total_injected / injection_time, 1),
+            "handled": len(latencies),
+            "unfinished": unfinished,
+        },
+        "handler_latency_ms": summarize(latencies),
+        "event_loop_lag_ms": summarize(lags),
+        "rest": {
+            "calls": rest_calls,
+            "calls_per_event": round((rest_calls - startup_calls) / max(total_injected, 1), 4),
+            "by_route": dict(api.calls),
+            "rate_limited": dict(api.rate_limited),
+        },
+        "enforcement": enforcement.stats(),
+        "log_reporter": enforcement.log_reporter.stats(),
+        "flood_limiter": enforcement.flood_limiter.stats(),
+        "verdict_cache": verdict_cache.stats(),
+        "config_cache": config_cache.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test CustomBot against a local fake Discord")
+    parser.add_argument('--guilds', type=int, default=100, help="Synthetic guilds (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=1000, help="MESSAGE_CREATE events per second (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to inject events for (default: %(default)s)")
+    parser.add_argument('--chatter', type=float, default=90, help="Weight of messages outside appeal channels (default: %(default)s)")
+    parser.add_argument('--valid', type=float, default=6, help="Weight of valid appeals (default: %(default)s)")
+    parser.add_argument('--invalid', type=float, default=3, help="Weight of invalid appeals (default: %(default)s)")
+    parser.add_argument('--whitelisted', type=float, default=1, help="Weight of invalid appeals from whitelisted members (default: %(default)s)")
+    parser.add_argument('--flood', type=float, default=0, help="Weight of invalid appeals from one flooding user per guild (default: %(default)s)")
+    parser.add_argument('--api-latency', type=float, default=20, help="Simulated REST latency in ms (default: %(default)s)")
+    parser.add_argument('--global-limit', type=int, default=50, help="Global REST requests per second (default: %(default)s)")
+    parser.add_argument('--no-rate-limits', action='store_true', help="Serve every REST call without 429s")
+    parser.add_argument('--drain-timeout', type=float, default=30, help="Seconds to wait for in-flight handlers (default: %(default)s)")
+    parser.add_argument('--members', type=int, default=0, help="Members per guild, delivered as at startup chunking (default: %(default)s)")
+    parser.add_argument('--low-memory', action='store_true', help="Run the bot in low-memory mode")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (default: %(default)s)")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    parser.add_argument('--verbose', action='store_true', help="Keep the bot's own logging")
+    args = parser.parse_args()
+
+    # The bot keeps its config relative to the working directory, so paths
+    # given on the command line are resolved before moving into a fresh one
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix='ban-appeal-loadtest-')
+    os.chdir(workdir)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    latency = report["handler_latency_ms"]
+    print(f"{report['events']['achieved_rate']} events/s, handler p50 {latency.get('p50')}ms "
+          f"p99 {latency.get('p99')}ms, {report['rest']['calls_per_event']} REST calls/event "
+          f"(config in {workdir})", file=sys.stderr)
+    memory = report["memory"]
+    print(f"ready in {memory['time_to_ready_seconds']}s, RSS {memory['rss_mb_ready']}MB at ready and "
+          f"{memory['rss_mb_end']}MB at the end, {memory['cached_members']} members and "
+          f"{memory['cached_messages']} messages cached", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import bisect
+import asyncio
+import logging
+
+logger = logging.getLogger('discord')
+
+# Port for the Prometheus-style /metrics endpoint; 0 leaves it off
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Seconds between JSON dumps of every metric to stdout; 0 leaves it off
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '0'))
+
+# Latency buckets in seconds, from sub-millisecond checks to slow REST calls
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label_values, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+    def snapshot(self):
+        return {','.join(map(str, label_values)) or 'total': value for label_values, value in self._values.items()}
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = _format_labels(self.label_names, label_values, ('le', bound))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {series[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+    def snapshot(self):
+        result = {}
+        for label_values, series in self._series.items():
+            count = sum(series[:-1])
+            result[','.join(map(str, label_values)) or 'total'] = {
+                "count": count,
+                "sum": series[-1],
+                "mean": series[-1] / count if count else 0.0,
+            }
+        return result
+
+
+class Metrics:
+    """Counters and latency histograms for the bot, plus stats read on demand.
+
+    Everything is a no-op until `start()` enables it, so a disabled bot only
+    pays for an attribute check per instrumented call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = []
+        # name -> (help, type, callable returning a number or a dict of label -> number)
+        self._collectors = {}
+        self._runner = None
+        self._dump_task = None
+
+        self.stage_seconds = self.histogram(
+            'ban_appeal_stage_seconds', "Time spent in each stage of on_message and enforcement", ('stage',)
+        )
+        self.messages = self.counter(
+            'ban_appeal_messages_total', "Messages seen by on_message, by outcome", ('outcome',)
+        )
+        self.edits = self.counter(
+            'ban_appeal_edits_total', "Appeal edits seen by on_raw_message_edit, by outcome", ('outcome',)
+        )
+        self.api_calls = self.counter(
+            'ban_appeal_discord_api_calls_total', "Discord API calls made while enforcing, by stage and result",
+            ('stage', 'result')
+        )
+        self.command_seconds = self.histogram(
+            'ban_appeal_app_command_seconds', "Time from interaction creation to command completion", ('command',)
+        )
+        self.commands = self.counter(
+            'ban_appeal_app_commands_total', "Application commands handled, by result", ('command', 'result')
+        )
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self, name, help_text, metric_type, read):
+        self._collectors[name] = (help_text, metric_type, read)
+
+    def collect_stats(self, prefix, help_text, read_stats):
+        """Export every number in a `stats()` dict as `<prefix>_<key>`."""
+        for key, value in read_stats().items():
+            if isinstance(value, (int, float)):
+                self.collect(f'{prefix}_{key}', f"{help_text} ({key})", 'gauge',
+                             lambda key=key: read_stats()[key])
+
+    def now(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def stage(self, name, start):
+        """Record the time since `start` for a stage and return the new start."""
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        self.stage_seconds.observe(now - start, name)
+        return now
+
+    def count(self, counter, *label_values):
+        if self.enabled:
+            counter.inc(*label_values)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, (help_text, metric_type, read) in self._collectors.items():
+            value = read()
+            if value is None:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if isinstance(value, dict):
+                for label, labelled_value in value.items():
+                    lines.append(f'{name}{{key="{label}"}} {labelled_value}')
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        data = {metric.name: metric.snapshot() for metric in self._metrics}
+        for name, (_, _, read) in self._collectors.items():
+            data[name] = read()
+        return data
+
+    async def start(self, port=METRICS_PORT, host=METRICS_HOST, dump_interval=METRICS_DUMP_INTERVAL):
+        if not port and not dump_interval:
+            return
+        self.enabled = True
+        if port:
+            from aiohttp import web
+
+            async def handle(request):
+                return web.Response(body=self.render().encode('utf-8'),
+                                    headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+            app = web.Application()
+            app.router.add_get('/metrics', handle)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, port).start()
+            logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        if dump_interval:
+            self._dump_task = asyncio.get_running_loop().create_task(self._dump_periodically(dump_interval))
+
+    async def _dump_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            sys.stdout.write(json.dumps({"metrics": self.snapshot(), "time": time.time()}) + '\n')
+            sys.stdout.flush()
+
+    async def stop(self):
+        if self._dump_task is not None:
+            self._dump_task.cancel()
+            self._dump_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
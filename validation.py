@@ -0,0 +1,275 @@
+import os
+import re
+import sys
+import time
+import collections
+
+DEFAULT_MESSAGE_FORMAT = "AC Driver Name:\nSteam ID:\nDetails:"
+
+STEAM_ID_LABEL = 'Steam ID'
+# A SteamID64 for an individual account is this base plus a non-zero 32-bit
+# account ID, so every valid one is 17 digits starting 765611 or 765612
+# ([0-9] rather than \d, which also matches non-ASCII digits)
+STEAM_ID64_BASE = 76561197960265728
+STEAM_ID64_MAX = STEAM_ID64_BASE + 0xFFFFFFFF
+STEAM_ID64_PATTERN = re.compile(r'76561[12][0-9]{11}')
+
+# Verdicts for recently checked appeal texts, kept within this many bytes
+# (0 turns the cache off) and for this many seconds
+VERDICT_CACHE_MAX_BYTES = int(os.getenv('VERDICT_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+VERDICT_CACHE_TTL = float(os.getenv('VERDICT_CACHE_TTL', '600'))
+# Rough size of one cache entry besides the text and values it holds: key
+# tuple, entry tuple and the OrderedDict link
+VERDICT_ENTRY_OVERHEAD = 280
+
+
+def is_valid_steam_id(steam_id):
+    return (
+        STEAM_ID64_PATTERN.fullmatch(steam_id) is not None
+        and STEAM_ID64_BASE < int(steam_id) <= STEAM_ID64_MAX
+    )
+
+
+class ValidationResult:
+    """Outcome of checking one appeal against a guild's format.
+
+    `reason` is None for a valid appeal, 'format' when a line is missing or
+    out of order and 'steam_id' when the Steam ID line holds a bad value.
+    `field` names the format line that failed and `values` maps each label
+    that was read to the text after its colon.
+    """
+
+    __slots__ = ('reason', 'field', 'values')
+
+    def __init__(self, reason=None, field=None, values=None):
+        self.reason = reason
+        self.field = field
+        self.values = values if values is not None else {}
+
+    @property
+    def valid(self):
+        return self.reason is None
+
+    @property
+    def steam_id(self):
+        return self.values.get(STEAM_ID_LABEL)
+
+    def __repr__(self):
+        return f"ValidationResult(reason={self.reason!r}, field={self.field!r}, values={self.values!r})"
+
+
+class FormatValidator:
+    """A guild's `message_format`, compiled once into per-line label patterns.
+
+    Each line of the format is a label followed by a colon. An appeal is valid
+    when its first lines start with those labels in order (later lines are
+    free text, so Details can span several lines) and any Steam ID line holds
+    a valid SteamID64.
+    """
+
+    def __init__(self, message_format=DEFAULT_MESSAGE_FORMAT, ignore_case=False, tolerant_whitespace=False):
+        self.message_format = message_format
+        self.ignore_case = ignore_case
+        self.tolerant_whitespace = tolerant_whitespace
+
+        flags = re.IGNORECASE if ignore_case else 0
+        self._fields = []
+        for section in message_format.split('\n'):
+            label = section.split(':')[0]
+            if tolerant_whitespace:
+                pattern = r'\s*' + r'\s+'.join(re.escape(word) for word in label.split())
+            else:
+                pattern = re.escape(label)
+            is_steam_id = STEAM_ID_LABEL in section
+            key = STEAM_ID_LABEL if is_steam_id else label.strip()
+            self._fields.append((label, key, re.compile(pattern, flags).match, is_steam_id))
+        self._line_count = len(self._fields)
+
+    @property
+    def source(self):
+        return (self.message_format, self.ignore_case, self.tolerant_whitespace)
+
+    def validate(self, content):
+        return self.validate_normalized(normalize_content(content))
+
+    def validate_normalized(self, content):
+        # Split off only the lines the format covers; the rest stays in one trailing chunk
+        lines = content.split('\n', self._line_count)
+        values = {}
+        for line, (label, key, match, is_steam_id) in zip(lines, self._fields):
+            if match(line) is None:
+                return ValidationResult('format', label, values)
+            _, colon, value = line.partition(':')
+            if is_steam_id:
+                if not colon:
+                    return ValidationResult('format', label, values)
+                value = value.strip()
+                values[key] = value
+                if value and not is_valid_steam_id(value):
+                    return ValidationResult('steam_id', label, values)
+            elif colon:
+                values[key] = value.strip()
+        # The lines that are there are fine, so report the first missing one
+        if len(lines) < self._line_count:
+            return ValidationResult('format', self._fields[len(lines)][0], values)
+        return ValidationResult(values=values)
+
+
+def normalize_content(content):
+    """The form of an appeal that validation sees: stripped, with plain newlines."""
+    content = content.strip()
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+
+def format_source(format_config):
+    return (
+        format_config.get('message_format', DEFAULT_MESSAGE_FORMAT),
+        bool(format_config.get('format_ignore_case', False)),
+        bool(format_config.get('format_tolerant_whitespace', False)),
+    )
+
+
+class FormatValidatorCache:
+    """Compiled validators per appeal channel, rebuilt only when the format changes."""
+
+    def __init__(self):
+        self._validators = {}
+
+    def get(self, channel_id, format_config):
+        validator = self._validators.get(channel_id)
+        source = format_source(format_config)
+        if validator is None or validator.source != source:
+            validator = self._validators[channel_id] = FormatValidator(*source)
+        return validator
+
+    def discard(self, channel_id):
+        self._validators.pop(channel_id, None)
+
+
+format_validators = FormatValidatorCache()
+
+
+class RoleWhitelists:
+    """Whitelisted role IDs per appeal channel, held as frozensets.
+
+    A set is rebuilt only when the channel's `whitelisted_roles` list is
+    replaced, which happens whenever the format config is saved or reloaded.
+    """
+
+    def __init__(self):
+        self._sets = {}
+
+    def get(self, channel_id, format_config):
+        roles = format_config.get('whitelisted_roles') or ()
+        entry = self._sets.get(channel_id)
+        if entry is None or entry[0] is not roles:
+            entry = self._sets[channel_id] = (roles, frozenset(int(role_id) for role_id in roles))
+        return entry[1]
+
+    def is_exempt(self, channel_id, format_config, role_ids):
+        return not self.get(channel_id, format_config).isdisjoint(role_ids)
+
+    def discard(self, channel_id):
+        self._sets.pop(channel_id, None)
+
+
+role_whitelists = RoleWhitelists()
+
+
+class VerdictCache:
+    """Recent validation results by appeal channel and normalized content.
+
+    Rejected users tend to repost the same text, so its ValidationResult is
+    reused until `ttl` runs out. The text itself is the key: the dict lookup
+    hashes it anyway, and the equality check on a hit rules out collisions
+    a shorter digest could have. An entry holds the validator that produced
+    it and only counts when that is still the channel's validator, so
+    changing the format invalidates the entries made under the old one.
+    Least recently used entries are evicted to stay within `max_bytes`.
+    Results are shared and must not be mutated.
+    """
+
+    def __init__(self, max_bytes=VERDICT_CACHE_MAX_BYTES, ttl=VERDICT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # (channel_id, normalized content) -> (validator, expiry, result, size)
+        self._entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def validate(self, channel_id, validator, content):
+        if not self.max_bytes:
+            return validator.validate(content)
+        content = normalize_content(content)
+        key = (channel_id, content)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] is validator and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry[1] <= now:
+                self.expired += 1
+            self._remove(key)
+        self.misses += 1
+        result = validator.validate_normalized(content)
+        size = VERDICT_ENTRY_OVERHEAD + sys.getsizeof(content) + sum(map(sys.getsizeof, result.values.values()))
+        self._entries[key] = (validator, now + self.ttl, result, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return result
+
+    def _remove(self, key):
+        self.bytes -= self._entries.pop(key)[3]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+verdict_cache = VerdictCache()
+
+
+def validate_appeal(channel_id, format_config, content):
+    """Check an appeal's format and Steam ID as every appeal path does.
+
+    `format_config` is the appeal channel's settings. Reposts of a recently
+    checked text reuse its verdict.
+    """
+    return verdict_cache.validate(channel_id, format_validators.get(channel_id, format_config), content)
+
+
+def check_appeal(channel_id, format_config, content, role_ids):
+    """Run the checks `on_message` applies to an appeal, without Discord objects.
+
+    `format_config` is the appeal channel's settings. Returns None when one
+    of `role_ids` is whitelisted, otherwise the ValidationResult for `content`.
+    The bot runs its flood limit between the two steps; it doesn't depend on
+    the content, so it is left out here.
+    """
+    if role_whitelists.is_exempt(channel_id, format_config, role_ids):
+        return None
+    return validate_appeal(channel_id, format_config, content)